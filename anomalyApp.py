@@ -5,8 +5,26 @@ import sys
 import os
 import logging
 import math
+import json
+import threading
+import zlib
+import struct
 from ApplaunchClass import ApplaunchClass
+from motionstats import MappedHistory, MotionRollup, RunningMoments, SeasonalProfile, SplitWindow, ZProbTable, sampleTime, zprob
+from detectorfleet import DetectorFleet
+from detectors import CachedDetector, DetectorEngine, engineOptions, makeEngine, parseEngineSpec, registerEngine
+from scorer import BackgroundScorer
+from snapshot import SnapshotWriter, readSnapshot, snapshotPath
+from shards import ShardPool, ShardStream
+from ingest import POLICIES, IngestPolicy, makePolicy
 import operator
+import time
+
+log = logging.getLogger(__name__)
+
+# largest points a motionHistory query honours; larger requests are reduced
+# to it, and a reply has at most that many rows
+MAX_HISTORY_POINTS = 300
 
 class anomalyApp(ApplaunchClass):
     def init(self, **params):
@@ -17,26 +35,251 @@ class anomalyApp(ApplaunchClass):
         
         self.mixes = {}
         self.vidNames = []
+        # rollup=1 keeps a MotionRollup of each stream (about 150 KB) for the
+        # motionHistory command
+        self.rollups = {}       # stream name -> MotionRollup
+        self.rollupLocks = {}   # stream name -> lock between rollup updates and queries
+        self.ingestErrors = {}  # stream name -> messages whose handling raised
+        # stream name -> ingest.IngestPolicy; ingest=every=<n>, latest=<seconds> or
+        # sum=<seconds> sets the default, the same addVideo options set one stream's
+        self.policies = {}
+        # ztable=1 converts z-values with an interpolated table instead of the polynomial
+        self.zTable = ZProbTable() if self.flag("ztable") else None
+        # fleet=1 keeps every window-engine stream in one columnar DetectorFleet (needs numpy)
+        self.fleet = DetectorFleet(zTable=self.zTable) if self.flag("fleet") else None
+        # mmap=<dir> keeps window histories in memory-mapped files there instead,
+        # one per stream, which outlive the process
+        if self.defaults.get("mmap"):
+            self.fleet = None
+            if not os.path.isdir(self.defaults["mmap"]):
+                os.makedirs(self.defaults["mmap"])
+        # profiles=<dir> keeps the time-of-day profiles of seasonal=<slots> streams
+        # there, one file per stream, loaded again when the stream is added and
+        # saved by the snapshot pass
+        if self.defaults.get("profiles") and not os.path.isdir(self.defaults["profiles"]):
+            os.makedirs(self.defaults["profiles"])
+        # welford=1 trains detectors with numerically stable RunningMoments
+        self.normalizer = RunningMoments if self.flag("welford") else Normalizer
+        # workers=<n> runs the detectors in n processes, streams assigned by name hash;
+        # forked before any background thread starts
+        self.shards = None
+        if int(self.defaults.get("workers") or 0) > 0:
+            self.fleet = None
+            self.shards = ShardPool(int(self.defaults["workers"]), self.buildShardDetector)
+        # scoreInterval=<seconds> scores every stream in the background and
+        # anomalyDetect answers from the latest snapshot
+        self.scorer = None
+        if float(self.defaults.get("scoreInterval") or 0) > 0:
+            self.scorer = BackgroundScorer(self.scoreAll, float(self.defaults["scoreInterval"]))
+            self.scorer.start()
+        # snapshot=<dir> writes detector state there every snapshotInterval seconds
+        # (default 60) and launchVideo restores streams from it; the same pass
+        # saves the profiles=<dir> profiles
+        self.specs = {}         # stream name -> engine spec its state belongs to
+        self.snapshots = None
+        if self.defaults.get("snapshot") or self.defaults.get("profiles"):
+            self.snapshots = SnapshotWriter(self.snapshotSources,
+                                            self.defaults.get("snapshot") or self.defaults["profiles"],
+                                            float(self.defaults.get("snapshotInterval", 60)),
+                                            float(self.defaults.get("snapshotBudget", 1.0)))
+            self.snapshots.start()
         
         return self.return_success(**self.state)
-        
-    def launchVideo(self,videoName):
+
+    def shutdown(self):
+        if getattr(self, "scorer", None) is not None:
+            self.scorer.stop()
+        if getattr(self, "snapshots", None) is not None:
+            self.snapshots.stop()
+        if getattr(self, "shards", None) is not None:
+            self.shards.stop()
+        ApplaunchClass.shutdown(self)
+
+    def flag(self, name):
+        # init parameters arrive as strings from the applaunch POST
+        return str(self.defaults.get(name, "")).lower() in ("1", "true", "yes", "on")
+
+    def makeDetector(self, engine, options={}, videoName=None):
+        # engines come from the detectors registry; the app-wide settings
+        # are passed to the engines that take them
+        params = {}
+        accepted = engineOptions(engine)
+        settings = [("zTable", self.zTable), ("normalizer", self.normalizer)]
+        if self.defaults.get("mmap") and videoName is not None:
+            settings.append(("path", os.path.join(self.defaults["mmap"], videoName + ".ring")))
+        if self.defaults.get("profiles") and videoName is not None:
+            settings.append(("profilePath", self.profilePath(videoName)))
+        for (key, value) in settings:
+            if key in accepted:
+                params[key] = value
+        params.update(options)
+        return makeEngine(engine, **params)
+
+    def buildShardDetector(self, videoName, engine, options):
+        # runs in the shard worker process, which also keeps the stream's rollup
+        return ShardStream(CachedDetector(self.makeDetector(engine, options, videoName)),
+                           MotionRollup() if self.flag("rollup") else None)
+
+    def launchVideo(self,videoName,engine="window",options={}):
         if not hasattr(self,"anomalyDetectors"):
             self.anomalyDetectors = {"emp":1}
         def outer(vName):
             if self.anomalyDetectors is None:
                 self.anomalyDetectors = {"emp":1}
+            rollup = vName in self.rollups
             def handleMsg(data):
                 try:
                     self.anomalyDetectors[vName].update(data)
-                except:
-                    pass
-            return handleMsg
-        self.anomalyDetectors[videoName] = AnomalyDetector()
+                    if rollup:
+                        self.rollup(vName, data)
+                except Exception:
+                    self.ingestError(vName)
+            def handleFleetMsg(data):
+                try:
+                    self.fleet.update(vName, data)
+                    if rollup:
+                        self.rollup(vName, data)
+                except Exception:
+                    self.ingestError(vName)
+            def handleShardMsg(data):
+                try:
+                    self.anomalyDetectors[vName].update(data)   # the worker keeps the rollup
+                except Exception:
+                    self.ingestError(vName)
+            handler = handleMsg
+            if self.fleet is not None and vName in self.fleet:
+                handler = handleFleetMsg
+            elif self.shards is not None and vName in self.shards:
+                handler = handleShardMsg
+            handler = self.admitter(vName, handler)
+            if self.defaults.get("record"):
+                return self.recorder(vName, handler)
+            return handler
+        spec = engine + ":" + ",".join("%s=%s" % kv for kv in sorted(options.items()))
+        # the ingestion policy options (every, latest, sum) are the app's, the rest the engine's
+        options = dict(options)
+        policy = self.defaults.get("ingest") and self.defaults["ingest"].split("=", 1)
+        for key in POLICIES:
+            if key in options:
+                policy = (key, options.pop(key))
+        self.policies[videoName] = makePolicy(*policy) if policy else IngestPolicy()
+        if self.flag("rollup"):
+            self.rollups[videoName] = MotionRollup()
+            self.rollupLocks[videoName] = threading.Lock()
+        self.ingestErrors[videoName] = 0
+        if self.shards is not None:
+            self.anomalyDetectors[videoName] = self.shards.addStream(videoName, engine, options)
+            if self.flag("rollup"):
+                self.rollups[videoName] = self.anomalyDetectors[videoName]
+        elif self.fleet is not None and engine == "window" and not options:
+            self.fleet.addStream(videoName)
+        else:
+            self.anomalyDetectors[videoName] = CachedDetector(self.makeDetector(engine, options, videoName))
+        if self.defaults.get("snapshot"):
+            self.restore(videoName, spec)
+        self.specs[videoName] = spec     # snapshotted from here on
         vid = self.mo.jlaunch("LoopVideo",src=videoName + ".flv",dst=videoName)
         opti = self.mo.jlaunch("DetectMovement",src=videoName,dst=videoName+"Move",rx_msg_callback=outer(videoName))
         return (vid,opti)
 
+    def restore(self, vName, spec):
+        # warm start from the stream's snapshot if it was taken with the same engine spec
+        path = snapshotPath(self.defaults["snapshot"], vName)
+        if not os.path.exists(path):
+            return
+        try:
+            (saved, state) = readSnapshot(path)
+            if saved != spec:
+                raise ValueError("%s: snapshot of %s, stream uses %s" % (path, saved, spec))
+            if self.fleet is not None and vName in self.fleet:
+                self.fleet.restore(vName, state)
+            else:
+                self.anomalyDetectors[vName].restore(state)
+        except (IOError, ValueError, struct.error, zlib.error), e:
+            self.log.warning("not restoring %s: %s" % (vName, e))
+
+    def profilePath(self, vName):
+        return os.path.join(self.defaults["profiles"], vName + ".profile")
+
+    def snapshotSources(self):
+        # (path, spec, pack) of the snapshot and profile of every stream launchVideo
+        # has finished adding
+        sources = []
+        for vName in sorted(self.specs):
+            detector = None
+            if self.fleet is not None and vName in self.fleet:
+                pack = lambda vName=vName: self.fleet.pack(vName)
+            else:
+                detector = self.anomalyDetectors[vName]
+                pack = detector.pack
+            if self.defaults.get("snapshot"):
+                sources.append((snapshotPath(self.defaults["snapshot"], vName),
+                                self.specs[vName], pack))
+            if self.defaults.get("profiles") and detector is not None:
+                sources.append((self.profilePath(vName), "profile", detector.packSidecar))
+        return sources
+
+    def admitter(self, vName, handler):
+        # apply the stream's ingestion policy before handler sees a message
+        policy = self.policies[vName]
+        def admitMsg(data):
+            try:
+                data = policy.offer(data)
+            except Exception:
+                self.ingestError(vName)
+                return
+            if data is not None:
+                handler(data)
+        return admitMsg
+
+    def recorder(self, vName, handler):
+        # record=<dir> appends every message to <dir>/<stream>.jsonl for replay.py,
+        # stamped with the receive time if the pipeline did not stamp it
+        out = open(os.path.join(self.defaults["record"], vName + ".jsonl"), "a")
+        def recordMsg(data):
+            stamped = data if "timestamp" in data else dict(data, timestamp=time.time())
+            out.write(json.dumps(stamped) + "\n")
+            handler(data)
+        return recordMsg
+
+    def rollup(self, vName, data):
+        with self.rollupLocks[vName]:
+            self.rollups[vName].update(sampleTime(data),
+                                       [data["nRight"],data["nLeft"],data["nUp"],data["nDown"]])
+
+    def ingestError(self, vName):
+        # a bad message must not stop the stream; count it and log the first and every 1000th
+        self.ingestErrors[vName] = self.ingestErrors.get(vName, 0) + 1
+        if self.ingestErrors[vName] % 1000 == 1:
+            self.log.exception("message %d for %s failed" % (self.ingestErrors[vName], vName))
+
+    def scoreStreams(self, anoStreams):
+        # anomaly values (1 - score) of anoStreams; streams still warming up are left
+        # out, whichever layout runs them, so one cannot fail the others' poll
+        returnVal = {}
+        scores = {}
+        if self.fleet is not None:  # score the fleet's streams in one pass
+            scores = self.fleet.anomalyDetect([s for s in anoStreams if s in self.fleet])
+        if self.shards is not None: # fan out to the shard workers and merge
+            scores = self.shards.anomalyDetect([s for s in anoStreams if s in self.shards])
+        for anoStream in anoStreams:
+            if anoStream in scores:
+                if scores[anoStream] is not None:
+                    returnVal[anoStream] = 1 - scores[anoStream]
+            else:
+                try:
+                    returnVal[anoStream] = 1 - self.anomalyDetectors[anoStream].anomalyDetect()
+                except ZeroDivisionError:
+                    pass    # still warming up
+        return returnVal
+
+    def scoreAll(self):
+        # one background scorer cycle, over the streams launchVideo has finished adding
+        detectors = getattr(self, "anomalyDetectors", {})
+        streams = [s for s in set(self.vidNames)
+                   if s in detectors or (self.fleet is not None and s in self.fleet)]
+        return self.scoreStreams(streams)
+
     def launchMix(self,mixName, mixVids):
         theMix = self.mo.jlaunch("LayoutMix",dst=mixName)
         for mixVid in mixVids:
@@ -63,13 +306,14 @@ class anomalyApp(ApplaunchClass):
     def GET(self, **params):
         returnVal = {}  # the GET response message
         #try:
-        commandType = params["commandType"] # can be addVideo, makeMix, or anomalyDetect
+        commandType = params["commandType"] # can be addVideo, makeMix, anomalyDetect, scoreCacheStats, scorerStats, snapshotStats, shardStats, ingestStats, changeEvents or motionHistory
         if commandType == "addVideo":       # the user wants us to start recording motion vector data for a video
             argString = params["argString"] # this string tells us what videos to add. It takes the form "video1|video2|video3" for adding three videos
-            vidsToAdd = argString.split('|')
+            vidsToAdd = argString.split('|')  # each may name its detector engine and options, e.g. "video1:ewma:halflife=30"
             for vidToAdd in vidsToAdd:      # for each video, add it to our list and launch it
-                self.vidNames.append(vidToAdd)
-                self.launchVideo(vidToAdd)
+                vidName, engine, options = parseEngineSpec(vidToAdd)
+                self.vidNames.append(vidName)
+                self.launchVideo(vidName, engine, options)
             returnVal["wasSuccess"] = "Yes"
         elif commandType == "makeMix":      # create a mix of several videos
             argString = params["argString"]   # this string tells us what streams to add to the mix. It takes the form "mixName|stream1|stream2|stream3" for adding 3 streams
@@ -81,8 +325,66 @@ class anomalyApp(ApplaunchClass):
         elif commandType == "anomalyDetect": # run an anomaly detection
             argString = params["argString"] # this string tells us what streams we should run anomaly detection on
             anoStreams = argString.split('|')
-            for anoStream in anoStreams:
-                returnVal[anoStream] = 1 - self.anomalyDetectors[anoStream].anomalyDetect()
+            if self.scorer is not None:     # read the background scorer's snapshot, no scoring here
+                scores = self.scorer.snapshot.scores
+                for anoStream in anoStreams:
+                    if anoStream in scores:
+                        returnVal[anoStream] = scores[anoStream]
+            else:                           # streams still warming up are left out
+                returnVal.update(self.scoreStreams(anoStreams))
+            returnVal["wasSuccess"] = "Yes"
+        elif commandType == "scorerStats": # cycle duration and lag of the background scorer
+            if self.scorer is not None:
+                returnVal.update(self.scorer.stats())
+                returnVal["wasSuccess"] = "Yes"
+            else:
+                returnVal["wasSuccess"] = "No"
+        elif commandType == "scoreCacheStats": # how often polls were answered from the score cache
+            argString = params["argString"] # the streams to report, "stream1|stream2"
+            for stream in argString.split('|'):
+                if self.fleet is not None and stream in self.fleet:
+                    returnVal[stream] = self.fleet.stats(stream)
+                else:
+                    returnVal[stream] = self.anomalyDetectors[stream].stats()
+            returnVal["wasSuccess"] = "Yes"
+        elif commandType == "shardStats": # streams, messages and errors of each shard worker
+            if self.shards is not None:
+                returnVal["workers"] = self.shards.stats()
+                returnVal["wasSuccess"] = "Yes"
+            else:
+                returnVal["wasSuccess"] = "No"
+        elif commandType == "snapshotStats": # timing and size of the detector snapshots
+            if self.snapshots is not None:
+                returnVal.update(self.snapshots.stats())
+                returnVal["wasSuccess"] = "Yes"
+            else:
+                returnVal["wasSuccess"] = "No"
+        elif commandType == "motionHistory": # trend lines of past motion, from the rollups
+            argString = params["argString"] # the streams to report, "stream1|stream2"
+            end = float(params.get("end", time.time()))         # range in epoch seconds, default the last hour
+            start = float(params.get("start", end - 3600))
+            points = min(int(params.get("points", 50)), MAX_HISTORY_POINTS)   # at most this many rows
+            if self.flag("rollup"):
+                for stream in argString.split('|'):
+                    with self.rollupLocks[stream]:
+                        returnVal[stream] = self.rollups[stream].query(start, end, points)
+                returnVal["wasSuccess"] = "Yes"
+            else:
+                returnVal["wasSuccess"] = "No"  # started without rollup=1
+        elif commandType == "changeEvents": # change points found by change-detecting engines (cusum)
+            argString = params["argString"] # the streams to report, "stream1|stream2"
+            since = int(params.get("since", -1))                # only changes after this sample number
+            for stream in argString.split('|'):
+                if stream in self.anomalyDetectors:
+                    returnVal[stream] = self.anomalyDetectors[stream].changes(since)
+                else:
+                    returnVal[stream] = []  # fleet streams run the window engine
+            returnVal["wasSuccess"] = "Yes"
+        elif commandType == "ingestStats": # messages received, aggregated, dropped and failed, and saturated sums, per stream
+            argString = params["argString"] # the streams to report, "stream1|stream2"
+            for stream in argString.split('|'):
+                returnVal[stream] = self.policies[stream].stats()
+                returnVal[stream]["errors"] = self.ingestErrors[stream]
             returnVal["wasSuccess"] = "Yes"
         #except:      # In case of exception, indicate that something went wrong
         #    returnVal["wasSuccess"] = "No"
@@ -103,6 +405,11 @@ class Normalizer:
         self.s += x
         self.S += x**2
         self.n += 1
+    def remove(self,x):
+        # inverse of update, used when a sample leaves a sliding window
+        self.s -= x
+        self.S -= x**2
+        self.n -= 1
     def mean(self):
         return self.s/self.n
     def stdev(self):
@@ -110,63 +417,154 @@ class Normalizer:
     def z(self,v):
         return (v - self.mean())/self.stdev()
     def zprob(self,z):
-        Z_MAX = 6.0 # maximum meaningful z-value
-        if z == 0.0:
-            x = 0.0
-        else:
-            y = 0.5 * math.fabs(z)
-            if y >= (Z_MAX*0.5):
-                x = 1.0
-            elif (y < 1.0):
-                w = y*y
-                x = ((((((((0.000124818987 * w-0.001075204047) * w +0.005198775019) * w-0.019198292004) * w +0.059054035642) * w-0.151968751364) * w +0.319152932694) * w-0.531923007300) * w +0.797884560593) * y * 2.0
-            else:
-                y = y - 2.0
-                x = (((((((((((((-0.000045255659 * y+0.000152529290) * y -0.000019538132) * y-0.000676904986) * y +0.001390604284) * y-0.000794620820) * y -0.002034254874) * y+0.006549791214) * y -0.010557625006) * y+0.011630447319) * y -0.009279453341) * y+0.005353579108) * y -0.002141268741) * y+0.000535310849) * y +0.999936657524
-        if z > 0.0:
-            prob = ((x+1.0)*0.5)
-        else:
-            prob = ((1.0-x)*0.5)
-        return prob
+        return zprob(z)
     def valprob(self,v):
         return self.zprob(self.z(v))
-class AnomalyDetector:
-    def __init__(self,trainSet=20000):
-        self.history = []
+class AnomalyDetector(DetectorEngine):
+    def __init__(self,trainSet=20000,incremental=False,zTable=None,normalizer=Normalizer,path=None,
+                 seasonal=0,seasonalMin=1000,profilePath=None):
         self.ts = trainSet
+        # in incremental mode the training normalizers and the test sums are
+        # kept up to date by update(), so anomalyDetect() is O(1)
+        self.incremental = incremental
+        # optional motionstats.ZProbTable used instead of Normalizer.zprob
+        self.zTable = zTable
+        # Normalizer, or motionstats.RunningMoments for long windows
+        self.normalizer = normalizer
+        # with a path the history is a motionstats.MappedHistory file, and rows
+        # left in it by an earlier run are picked up again
+        history = MappedHistory(path, trainSet) if path else None
+        self.resetNormalizers()
+        self.testSum = [0.0, 0.0, 0.0, 0.0]
+        if incremental:
+            self.window = SplitWindow(trainSet, self.trainRow, self.testRow, history)
+        else:
+            self.window = SplitWindow(trainSet, history=history)
+        self.history = self.window.history
+        # seasonal=<slots> also keeps a motionstats.SeasonalProfile of the time of day,
+        # and the test window is scored against its current slot once that slot
+        # has seasonalMin samples; with a profilePath the profile is loaded from
+        # that file, and packSidecar() gives the app's snapshot pass its bytes
+        self.profile = SeasonalProfile(seasonal) if seasonal else None
+        self.seasonalMin = seasonalMin
+        self.profilePath = profilePath
+        self.slot = None
+        if self.profile is not None and profilePath and os.path.exists(profilePath):
+            try:
+                profile = SeasonalProfile.unpack(readSnapshot(profilePath)[1])
+                if profile.slots != seasonal:
+                    raise ValueError("%s has %d slots" % (profilePath, profile.slots))
+                self.profile = profile
+            except (IOError, ValueError, struct.error, zlib.error), e:
+                log.warning("starting a new profile: %s" % e)
+    def reset(self):
         self.resetNormalizers()
+        self.testSum = [0.0, 0.0, 0.0, 0.0]
+        self.window.reset()
+    def nbytes(self):
+        if self.profile is not None:
+            return self.history.nbytes() + self.profile.nbytes()
+        return self.history.nbytes()
+    def pack(self):
+        if self.profile is not None:
+            slot = self.slot if self.slot is not None else -1
+            return self.profile.pack() + struct.pack("<q", slot) + self.window.pack()
+        return self.window.pack()
+    def restore(self, data):
+        # training and test sums are rebuilt from the restored rows
+        self.resetNormalizers()
+        self.testSum = [0.0, 0.0, 0.0, 0.0]
+        if self.profile is not None:
+            size = len(self.profile.pack())
+            profile = SeasonalProfile.unpack(data[:size])
+            if profile.slots != self.profile.slots:
+                raise ValueError("AnomalyDetector snapshot has %d slots" % profile.slots)
+            self.profile = profile
+            slot = struct.unpack("<q", data[size:size + 8])[0]
+            self.slot = slot if slot >= 0 else None
+            data = data[size + 8:]
+        self.window.restore(data)
+    def packSidecar(self):
+        if self.profile is not None and self.profilePath:
+            return self.profile.pack()
+        return None
+
     def resetNormalizers(self):
-        self.R = Normalizer()
-        self.L = Normalizer()
-        self.U = Normalizer()
-        self.D = Normalizer()
+        self.R = self.normalizer()
+        self.L = self.normalizer()
+        self.U = self.normalizer()
+        self.D = self.normalizer()
     def update(self, dat):
-        self.history.append([dat["nRight"],dat["nLeft"],dat["nUp"],dat["nDown"]])
-        if len(self.history) == self.ts:
-            self.history.pop(0)
+        row = [dat["nRight"],dat["nLeft"],dat["nUp"],dat["nDown"]]
+        self.window.append(row)
+        if self.profile is not None:
+            t = sampleTime(dat)
+            self.slot = self.profile.slot(t)
+            self.profile.update(t, row)
+    def trainRow(self, row, sign):
+        if sign > 0:
+            self.R.update(row[0])
+            self.L.update(row[1])
+            self.U.update(row[2])
+            self.D.update(row[3])
+        else:
+            self.R.remove(row[0])
+            self.L.remove(row[1])
+            self.U.remove(row[2])
+            self.D.remove(row[3])
+    def testRow(self, row, sign):
+        self.testSum = [self.testSum[i] + sign*row[i] for i in xrange(0,4)]
     def anomalyDetect(self):
+        if self.incremental:
+            return self.incrementalDetect()
+        return self.batchDetect()
+    def incrementalDetect(self):
+        counter = float(self.window.testCount())
+        testingVector = [self.testSum[i]/counter for i in xrange(0,4)]
+        return self.score(testingVector)
+    def batchDetect(self):
         testingIndex = len(self.history) - self.ts
         if len(self.history) < self.ts:
             testingIndex = (9*len(self.history))/10
         self.resetNormalizers()
         testingVector = [0.0, 0.0, 0.0, 0.0]
         for x in xrange(0,testingIndex):
-            self.R.update(self.history[x][0])
-            self.L.update(self.history[x][1])
-            self.U.update(self.history[x][2])
-            self.D.update(self.history[x][3])
+            row = self.history[x]
+            self.R.update(row[0])
+            self.L.update(row[1])
+            self.U.update(row[2])
+            self.D.update(row[3])
         
         counter = 0.0
         for x in xrange(testingIndex + 1, len(self.history)):
             counter += 1
-            testingVector = [testingVector[i] + self.history[x][i] for i in xrange(0,4)]
+            row = self.history[x]
+            testingVector = [testingVector[i] + row[i] for i in xrange(0,4)]
         testingVector = [testingVector[i]/counter for i in xrange(0,4)]
-        PR = self.R.valprob(testingVector[0])
-        PL = self.L.valprob(testingVector[1])
-        PU = self.U.valprob(testingVector[2])
-        PD = self.D.valprob(testingVector[3])
+        return self.score(testingVector)
+    def baseline(self):
+        # the current time-of-day slot once it has enough samples, else the training part
+        if self.profile is not None and self.slot is not None:
+            if self.profile.count(self.slot) >= self.seasonalMin:
+                return self.profile.moments(self.slot)
+        return [self.R, self.L, self.U, self.D]
+    def score(self, testingVector):
+        (R, L, U, D) = self.baseline()
+        if self.zTable is not None:
+            zp = self.zTable.zprob
+            PR = zp(R.z(testingVector[0]))
+            PL = zp(L.z(testingVector[1]))
+            PU = zp(U.z(testingVector[2]))
+            PD = zp(D.z(testingVector[3]))
+        else:
+            PR = R.valprob(testingVector[0])
+            PL = L.valprob(testingVector[1])
+            PU = U.valprob(testingVector[2])
+            PD = D.valprob(testingVector[3])
         return (PR + PL + PU + PD)/4.0
 
+registerEngine("window", AnomalyDetector, incremental=True)
+
 
 if __name__ == "__main__":
     logging.basicConfig(format="%(levelname)s %(message)s", stream=sys.stdout,
@@ -0,0 +1,1007 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+anomalybench.py
+
+Micro-benchmarks for the anomaly detectors in anomalyApp.
+
+Feeds synthetic DetectMovement messages into detectors and times scoring,
+so changes to the detector code can be measured without live pipelines.
+
+    python anomalybench.py incremental --windows 1000,10000,100000,1000000
+    python anomalybench.py history --windows 20000
+    python anomalybench.py fleet --windows 20000 --streams 10,100,1000
+    python anomalybench.py zprob
+    python anomalybench.py moments --windows 100000,1000000
+    python anomalybench.py time --rates 10,100,1000
+    python anomalybench.py quantile --windows 20000
+    python anomalybench.py median --windows 20000
+    python anomalybench.py divergence --windows 2000,20000,200000
+    python anomalybench.py markov --windows 20000
+    python anomalybench.py spectral --streams 1,10,100
+    python anomalybench.py warmup
+    python anomalybench.py idle
+    python anomalybench.py engines --engines "window,ewma:halflife=30;signal=10,quantile"
+    python anomalybench.py cache --windows 20000 --rates 0,1,10,100
+    python anomalybench.py mapped --windows 20000 --streams 100
+    python anomalybench.py shards --workers 0,1,2,4 --streams 16
+    python anomalybench.py stress --streams 8
+    python anomalybench.py changes --recordings "recordings/*.jsonl"
+
+"""
+
+import os
+import gc
+import sys
+import glob
+import json
+import math
+import time
+import shutil
+import tempfile
+import threading
+import random
+import argparse
+import multiprocessing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from anomalyApp import AnomalyDetector, Normalizer
+from detectors import ENGINES, CachedDetector, MedianDetector, QuantileDetector, \
+    SpectralBatch, TimeWindowDetector, makeEngine, parseEngineSpec
+from motionstats import DIRECTIONS, MotionHistory, ZProbTable, zprob, zprobs, \
+    RunningMoments, columnMoments, mergeMoments
+from detectorfleet import DetectorFleet
+from replay import Replay, readRecordings
+
+
+def motion_messages(count, seed=0):
+    """Generate `count` synthetic DetectMovement messages."""
+
+    rand = random.Random(seed)
+    for i in xrange(count):
+        yield {"nRight": rand.randint(0, 40), "nLeft": rand.randint(0, 40),
+               "nUp": rand.randint(0, 20), "nDown": rand.randint(0, 20)}
+
+
+def skewed_messages(count, mean=5.0, burst=0.0, seed=0):
+    """Messages with exponentially distributed counts of the given mean.
+
+    A `burst` fraction of them are crowded, with ten times the mean.
+    """
+
+    rand = random.Random(seed)
+    for i in xrange(count):
+        scale = mean * 10 if rand.random() < burst else mean
+        yield dict((direction, int(rand.expovariate(1.0 / scale))) for direction in DIRECTIONS)
+
+
+def stationary_scores(det, msgs, polls=20):
+    """Scores of `det` at `polls` polls in the second half of `msgs`."""
+
+    half = len(msgs) / 2
+    every = max(half / polls, 1)
+    scores = []
+    for (i, msg) in enumerate(msgs):
+        det.update(msg)
+        if i >= half and (i - half) % every == every - 1:
+            scores.append(det.anomalyDetect())
+    return scores
+
+
+def stationary_score(det, msgs, polls=20):
+    """Mean score of `det` over `polls` polls in the second half of `msgs`.
+
+    The messages come from one distribution, so an unbiased engine
+    averages 0.5 whatever that distribution is.
+    """
+
+    scores = stationary_scores(det, msgs, polls)
+    return sum(scores) / len(scores)
+
+
+def timed(func, repeat):
+    """Call func `repeat` times, return (last result, seconds per call)."""
+
+    start = time.time()
+    for i in xrange(repeat):
+        result = func()
+    return (result, (time.time() - start) / repeat)
+
+
+def bench_incremental(windows, scores=20, log=sys.stdout):
+    """Compare batch and incremental anomalyDetect at each window size.
+
+    Each detector is filled to its window, then `scores` rounds of one
+    update + one score are timed.  The scores of both modes must match.
+    """
+
+    log.write("%10s %14s %14s %10s %s\n" % ("window", "batch ms/poll",
+              "incr ms/poll", "speedup", "same score"))
+    for window in windows:
+        batch = AnomalyDetector(trainSet=window)
+        incremental = AnomalyDetector(trainSet=window, incremental=True)
+        for msg in motion_messages(window):
+            batch.update(msg)
+            incremental.update(msg)
+
+        tail = list(motion_messages(scores, seed=window))
+        state = {"i": 0}
+
+        def poll(det):
+            det.update(tail[state["i"] % scores])
+            state["i"] += 1
+            return det.anomalyDetect()
+
+        (batchScore, batchTime) = timed(lambda: poll(batch), scores)
+        state["i"] = 0
+        (incrScore, incrTime) = timed(lambda: poll(incremental), scores)
+        log.write("%10d %14.3f %14.3f %9.1fx %s\n" % (window, batchTime * 1000,
+                  incrTime * 1000, batchTime / max(incrTime, 1e-9),
+                  batchScore == incrScore))
+
+
+def list_history_bytes(history):
+    """Approximate heap bytes of the old list-of-lists history."""
+
+    total = sys.getsizeof(history)
+    for row in history:
+        total += sys.getsizeof(row)
+        total += sum(sys.getsizeof(v) for v in row if v > 256)
+    return total
+
+
+def bench_history(windows, messages=100000, log=sys.stdout):
+    """Steady-state per-message cost and memory of list history vs MotionHistory.
+
+    Both histories are filled to the window before timing, so every timed
+    message also evicts the oldest row.
+    """
+
+    log.write("%10s %14s %14s %14s %14s\n" % ("window", "list us/msg",
+              "ring us/msg", "list MB", "ring MB"))
+    msgs = list(motion_messages(messages))
+    for window in windows:
+        fill = [[dat["nRight"], dat["nLeft"], dat["nUp"], dat["nDown"]]
+                for dat in motion_messages(window - 1, seed=window)]
+        history = list(fill)
+        start = time.time()
+        for dat in msgs:
+            history.append([dat["nRight"], dat["nLeft"], dat["nUp"], dat["nDown"]])
+            if len(history) == window:
+                history.pop(0)
+        listTime = (time.time() - start) / messages
+
+        ring = MotionHistory(window)
+        for row in fill:
+            ring.append(row)
+        start = time.time()
+        for dat in msgs:
+            ring.append([dat["nRight"], dat["nLeft"], dat["nUp"], dat["nDown"]])
+            if len(ring) == window:
+                ring.popleft()
+        ringTime = (time.time() - start) / messages
+
+        log.write("%10d %14.3f %14.3f %14.3f %14.3f\n" % (window, listTime * 1e6,
+                  ringTime * 1e6, list_history_bytes(history) / 1e6,
+                  ring.nbytes() / 1e6))
+
+
+def bench_mapped(windows, streams, messages=2000, log=sys.stdout):
+    """Window detectors with heap vs memory-mapped histories, `streams` of each.
+
+    Every detector is filled to its window, then timed for `messages` more.
+    Reports the per-message cost, the heap objects gc tracks for the
+    histories and the bytes of heap arrays vs mapped files.
+    """
+
+    log.write("%10s %8s %14s %14s %12s %12s %12s\n" % ("window", "streams", "heap us/msg",
+              "mapped us/msg", "gc objects", "heap MB", "mapped MB"))
+    directory = tempfile.mkdtemp(prefix="anomalybench")
+    try:
+        for window in windows:
+            for count in streams:
+                msgs = list(motion_messages(window + messages))
+                result = []
+                for mapped in (False, True):
+                    gc.collect()
+                    objects = len(gc.get_objects())
+                    detectors = [AnomalyDetector(window, incremental=True,
+                                                 path=os.path.join(directory, "%d.ring" % k)
+                                                 if mapped else None)
+                                 for k in xrange(count)]
+                    for det in detectors:
+                        for dat in msgs[:window]:
+                            det.update(dat)
+                    start = time.time()
+                    for dat in msgs[window:]:
+                        for det in detectors:
+                            det.update(dat)
+                    perMsg = (time.time() - start) / (messages * count)
+                    gc.collect()
+                    result.append((perMsg, len(gc.get_objects()) - objects,
+                                   sum(det.nbytes() for det in detectors)))
+                    for det in detectors:
+                        if mapped:
+                            det.history.close()
+                    del detectors
+                log.write("%10d %8d %14.3f %14.3f %5d/%-6d %12.1f %12.1f\n" % (window, count,
+                          result[0][0] * 1e6, result[1][0] * 1e6, result[0][1], result[1][1],
+                          result[0][2] / 1e6, result[1][2] / 1e6))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_fleet(windows, streams, fill=1000, log=sys.stdout):
+    """Score a fleet with one DetectorFleet pass vs a per-detector loop.
+
+    Every stream gets `fill` messages before scoring, every 100th of
+    them with out-of-range counts that both sides must clamp alike.  The
+    per-detector loop uses incremental AnomalyDetectors, so both sides
+    do O(1) work per stream and the difference is interpreter overhead.
+    """
+
+    outOfRange = {"nRight": -1, "nLeft": 70000, "nUp": 2.7, "nDown": 3}
+
+    log.write("%10s %8s %14s %14s %10s %s\n" % ("window", "streams",
+              "loop ms/poll", "fleet ms/poll", "speedup", "same scores"))
+    for window in windows:
+        for count in streams:
+            names = ["stream%d" % k for k in xrange(count)]
+            fleet = DetectorFleet(trainSet=window)
+            detectors = {}
+            for name in names:
+                fleet.addStream(name)
+                detectors[name] = AnomalyDetector(trainSet=window, incremental=True)
+            for (k, name) in enumerate(names):
+                for (n, msg) in enumerate(motion_messages(fill, seed=k)):
+                    if n % 100 == 99:
+                        msg = outOfRange
+                    fleet.update(name, msg)
+                    detectors[name].update(msg)
+
+            def loop():
+                return dict((name, detectors[name].anomalyDetect()) for name in names)
+
+            (loopScores, loopTime) = timed(loop, 10)
+            # score() bypasses the fleet's cache, so every poll is a full pass
+            (fleetScores, fleetTime) = timed(lambda: fleet.score(names), 10)
+            log.write("%10d %8d %14.3f %14.3f %9.1fx %s\n" % (window, count,
+                      loopTime * 1000, fleetTime * 1000,
+                      loopTime / max(fleetTime, 1e-9), loopScores == fleetScores))
+
+
+def bench_zprob(count=100000, log=sys.stdout):
+    """Time the z-value to probability conversions on `count` z-values."""
+
+    rand = random.Random(0)
+    zs = [rand.gauss(0.0, 2.0) for i in xrange(count)]
+    zarray = numpy.array(zs) if numpy is not None else zs
+    table = ZProbTable()
+    log.write("%-22s %12s\n" % ("conversion", "ns/value"))
+    for (name, func) in [("zprob loop", lambda: [zprob(z) for z in zs]),
+                         ("zprobs", lambda: zprobs(zarray)),
+                         ("ZProbTable.zprob loop", lambda: [table.zprob(z) for z in zs]),
+                         ("ZProbTable.zprobs", lambda: table.zprobs(zarray))]:
+        (result, seconds) = timed(func, 5)
+        log.write("%-22s %12.1f\n" % (name, seconds / count * 1e9))
+    log.write("table max error vs zprob: %.3g\n" % table.max_error())
+
+
+def offset_rows(count, seed=0, base=60000):
+    """Motion rows with a large offset and a small spread."""
+
+    rand = random.Random(seed)
+    return [[base + rand.randint(0, 8) for d in xrange(4)] for i in xrange(count)]
+
+
+def offset_chunk_moments(chunk):
+    """columnMoments of offset_rows(*chunk), run inside a pool worker."""
+
+    return columnMoments(offset_rows(*chunk))
+
+
+def exact_stdev(values):
+    """Two-pass sample stdev with exactly rounded sums."""
+
+    n = len(values)
+    mean = math.fsum(values) / n
+    return math.sqrt(math.fsum((v - mean) ** 2 for v in values) / (n - 1))
+
+
+def bench_moments(windows, workers=4, log=sys.stdout):
+    """Accuracy of Normalizer vs RunningMoments, and chunked training.
+
+    The rows sit near 60000 with a spread of a few counts, which is where
+    the raw-sum stdev of Normalizer loses precision.  The same rows are
+    then trained in `workers` chunks on a process pool and merged; each
+    worker generates its own chunk, as it would read its own recording.
+    """
+
+    log.write("%10s %14s %14s %14s %12s %12s %12s\n" % ("window", "exact stdev",
+              "Normalizer err", "Welford err", "1 proc s", "pool s", "merge err"))
+    pool = multiprocessing.Pool(workers)
+    for window in windows:
+        size = (window + workers - 1) / workers
+        chunks = [(min(size, window - k), k) for k in xrange(0, window, size)]
+        rows = sum((offset_rows(*chunk) for chunk in chunks), [])
+        column = [row[0] for row in rows]
+        exact = exact_stdev(column)
+        naive = Normalizer()
+        for v in column:
+            naive.update(v)
+        try:
+            naiveErr = abs(naive.stdev() - exact)
+        except ValueError:
+            naiveErr = float("nan")  # negative variance
+        start = time.time()
+        single = columnMoments(sum((offset_rows(*chunk) for chunk in chunks), []))
+        singleTime = time.time() - start
+        start = time.time()
+        merged = mergeMoments(pool.map(offset_chunk_moments, chunks))
+        poolTime = time.time() - start
+        log.write("%10d %14.6f %14.3g %14.3g %12.3f %12.3f %12.3g\n" % (window,
+                  exact, naiveErr, abs(single[0].stdev() - exact), singleTime,
+                  poolTime, abs(merged[0].stdev() - single[0].stdev())))
+    pool.close()
+
+
+def bench_time(rates, seconds=600, log=sys.stdout):
+    """Count windows vs second windows covering `seconds` at each message rate.
+
+    The count-based AnomalyDetector needs rate*seconds rows to span the
+    same duration, the TimeWindowDetector always holds `seconds` buckets.
+    """
+
+    log.write("%8s %12s %14s %14s %14s %14s\n" % ("msg/s", "window rows",
+              "count us/msg", "time us/msg", "count MB", "time MB"))
+    for rate in rates:
+        count = rate * seconds
+        byCount = AnomalyDetector(trainSet=count + 1, incremental=True)
+        byTime = TimeWindowDetector(train=seconds * 9 / 10, test=seconds / 10)
+        msgs = list(motion_messages(count))
+        for (k, msg) in enumerate(msgs):
+            msg["timestamp"] = float(k) / rate
+        start = time.time()
+        for msg in msgs:
+            byCount.update(msg)
+        countTime = (time.time() - start) / count
+        start = time.time()
+        for msg in msgs:
+            byTime.update(msg)
+        timeTime = (time.time() - start) / count
+        log.write("%8d %12d %14.3f %14.3f %14.3f %14.3f\n" % (rate, count,
+                  countTime * 1e6, timeTime * 1e6, byCount.history.nbytes() / 1e6,
+                  byTime.nbytes() / 1e6))
+
+
+def bench_quantile(windows, log=sys.stdout):
+    """Memory and cost of QuantileDetector vs the row-history AnomalyDetector.
+
+    Each detector sees 2*window messages; the quantile sketch uses an
+    epoch of 90% of the window, like the training part.  The last three
+    columns are the mean score of a fresh detector on stationary uniform,
+    exponential and bursty (5% crowded) counts, which should be 0.5.
+    """
+
+    log.write("%10s %-20s %12s %12s %12s %8s %8s %8s\n" % ("window", "detector", "KB",
+              "us/msg", "ms/score", "uniform", "exp", "bursty"))
+    for window in windows:
+        msgs = list(motion_messages(2 * window))
+        stationary = [msgs, list(skewed_messages(2 * window)),
+                      list(skewed_messages(2 * window, burst=0.05))]
+        for (name, make) in [("window batch", lambda: AnomalyDetector(trainSet=window)),
+                             ("window incremental", lambda: AnomalyDetector(trainSet=window,
+                                                                            incremental=True)),
+                             ("quantile", lambda: QuantileDetector(epoch=window * 9 / 10))]:
+            det = make()
+            start = time.time()
+            for msg in msgs:
+                det.update(msg)
+            perMsg = (time.time() - start) / len(msgs)
+            (score, perScore) = timed(det.anomalyDetect, 5)
+            if isinstance(det, AnomalyDetector):
+                nbytes = det.history.nbytes()
+            else:
+                nbytes = det.nbytes()
+            means = [stationary_score(make(), data) for data in stationary]
+            log.write("%10d %-20s %12.1f %12.3f %12.3f %8.3f %8.3f %8.3f\n" % (window, name,
+                      nbytes / 1e3, perMsg * 1e6, perScore * 1000, means[0], means[1], means[2]))
+
+
+def bench_median(windows, burst=200, shift=8, log=sys.stdout):
+    """Cost of MedianDetector vs the incremental AnomalyDetector, and burst masking.
+
+    Each detector sees 2*window messages for the timing.  Then a `burst`
+    of crowded messages is fed and followed by as many messages as the
+    training part holds after the burst, with every count `shift` above
+    normal over the last test window; the "burst" column is the score on
+    that shift, which the burst's inflated stdev hides from the window
+    engine.  The "exp" and "bursty" columns are the mean score of a fresh
+    detector on stationary exponential and bursty (5% crowded) counts,
+    which should be 0.5.
+    """
+
+    log.write("%10s %-12s %12s %12s %12s %10s %10s %8s %8s\n" % ("window", "detector", "KB",
+              "us/msg", "ms/score", "score", "burst", "exp", "bursty"))
+    for window in windows:
+        msgs = list(motion_messages(2 * window))
+        stationary = [list(skewed_messages(2 * window)),
+                      list(skewed_messages(2 * window, burst=0.05))]
+        test = window / 10
+        for (name, make) in [("window", lambda: AnomalyDetector(trainSet=window,
+                                                                  incremental=True)),
+                             ("median", lambda: MedianDetector(trainSet=window))]:
+            det = make()
+            start = time.time()
+            for msg in msgs:
+                det.update(msg)
+            perMsg = (time.time() - start) / len(msgs)
+            (score, perScore) = timed(det.anomalyDetect, 5)
+            for msg in motion_messages(burst, seed=1):
+                det.update(dict((d, 400 + v) for (d, v) in msg.items()))
+            for msg in motion_messages(window - burst - test, seed=2):
+                det.update(msg)
+            for msg in motion_messages(test, seed=3):
+                det.update(dict((d, shift + v) for (d, v) in msg.items()))
+            shifted = det.anomalyDetect()
+            means = [stationary_score(make(), data) for data in stationary]
+            log.write("%10d %-12s %12.1f %12.3f %12.3f %10.4f %10.4f %8.3f %8.3f\n" % (window,
+                      name, det.nbytes() / 1e3, perMsg * 1e6, perScore * 1000, score,
+                      shifted, means[0], means[1]))
+
+
+def bench_divergence(windows, log=sys.stdout):
+    """Cost of DivergenceDetector against window length, and a change of shape.
+
+    Each detector sees 2*window messages for the timing.  Then a test
+    window of messages with the same means but every count at either end
+    of its range is fed; the "shape" column is the score after it, which
+    the mean-based window engine cannot tell from normal.
+    """
+
+    log.write("%10s %-22s %12s %12s %10s %10s\n" % ("window", "detector", "us/msg",
+              "ms/score", "score", "shape"))
+    for window in windows:
+        msgs = list(motion_messages(2 * window))
+        rand = random.Random(4)
+        shape = [dict((d, rand.choice((0, top))) for (d, top) in
+                      (("nRight", 40), ("nLeft", 40), ("nUp", 20), ("nDown", 20)))
+                 for k in xrange(window / 10)]
+        for spec in ("window", "divergence", "divergence:measure=kl"):
+            (_, engine, options) = parseEngineSpec("bench:" + spec)
+            det = makeEngine(engine, trainSet=window, **options)
+            start = time.time()
+            for msg in msgs:
+                det.update(msg)
+            perMsg = (time.time() - start) / len(msgs)
+            (score, perScore) = timed(det.anomalyDetect, 5)
+            for msg in shape:
+                det.update(msg)
+            log.write("%10d %-22s %12.3f %12.3f %10.4f %10.4f\n" % (window, spec,
+                      perMsg * 1e6, perScore * 1000, score, det.anomalyDetect()))
+
+
+def sticky_messages(count, run=20, seed=0, flip=False):
+    """Messages whose busiest direction persists for about `run` messages.
+
+    With `flip` the busy direction alternates between right and left on
+    every message instead, with the same share of each.
+    """
+
+    rand = random.Random(seed)
+    busy = "nRight"
+    for i in xrange(count):
+        if flip:
+            busy = "nLeft" if busy == "nRight" else "nRight"
+        elif rand.random() < 1.0 / run:
+            busy = rand.choice(("nRight", "nLeft"))
+        msg = {"nRight": rand.randint(0, 6), "nLeft": rand.randint(0, 6),
+               "nUp": rand.randint(0, 3), "nDown": rand.randint(0, 3)}
+        msg[busy] += 20
+        yield msg
+
+
+def bench_markov(windows, log=sys.stdout):
+    """Cost of TransitionDetector, and abrupt reversals it should catch.
+
+    Each detector sees 2*window messages whose busy direction changes
+    every 20 messages or so; the "reversals" column is the score after a
+    test window in which it flips between right and left on every
+    message, which leaves the mean of each direction unchanged.  On
+    stationary messages of that kind, "null" is a fresh detector's mean
+    score over 100 polls, which should be 0.5, and "far" the fraction of
+    those polls 0.25 or more from 0.5, which should be near 0.
+    """
+
+    log.write("%10s %-10s %12s %12s %10s %10s %8s %8s\n" % ("window", "detector", "us/msg",
+              "ms/score", "score", "reversals", "null", "far"))
+    for window in windows:
+        msgs = list(sticky_messages(2 * window))
+        stationary = list(sticky_messages(4 * window, seed=2))
+        flips = list(sticky_messages(window / 10, seed=1, flip=True))
+        for engine in ("window", "markov"):
+            det = makeEngine(engine, trainSet=window)
+            start = time.time()
+            for msg in msgs:
+                det.update(msg)
+            perMsg = (time.time() - start) / len(msgs)
+            (score, perScore) = timed(det.anomalyDetect, 5)
+            for msg in flips:
+                det.update(msg)
+            reversals = det.anomalyDetect()
+            scores = stationary_scores(makeEngine(engine, trainSet=window), stationary, 100)
+            far = len([x for x in scores if abs(x - 0.5) >= 0.25]) / float(len(scores))
+            log.write("%10d %-10s %12.3f %12.3f %10.4f %10.4f %8.3f %8.3f\n" % (window, engine,
+                      perMsg * 1e6, perScore * 1000, score, reversals,
+                      sum(scores) / len(scores), far))
+
+
+def timedRun(run, spent):
+    """Wrap SpectralBatch.run to add its seconds to spent[0]."""
+
+    def timed():
+        start = time.time()
+        run()
+        spent[0] += time.time() - start
+    return timed
+
+
+def bench_spectral(streams, messages=8192, poll=1024, log=sys.stdout):
+    """Per-message cost of SpectralDetector with transforms batched across streams.
+
+    `messages` periodic messages are fed to each of `streams` detectors in
+    turn and every stream is scored every `poll` rounds.  "batched" shares
+    one SpectralBatch, so each poll runs one rfft over every due stream;
+    "per stream" gives each detector a batch of its own.  "us/transform"
+    is the time spent in the batches per stream transformed.  "lost" is the
+    mean score over the streams after a further `poll` messages each
+    without the period.
+    """
+
+    log.write("%8s %-12s %10s %10s %12s %12s %8s\n" % ("streams", "batching", "rfft calls",
+              "transforms", "us/transform", "us/msg", "lost"))
+    rand = random.Random(0)
+    noise = [rand.gauss(0, 2) for k in xrange(messages + poll)]
+    msgs = []
+    for k in xrange(messages + poll):
+        level = 10 + (8 * math.sin(2 * math.pi * k / 40) if k < messages else 0)
+        msgs.append({"nRight": max(0, int(level + noise[k])), "nLeft": k % 5,
+                     "nUp": max(0, int(level / 2 + noise[k - 1])), "nDown": k % 3})
+    for count in streams:
+        for mode in ("batched", "per stream"):
+            shared = SpectralBatch(limit=count)
+            batches = [shared if mode == "batched" else SpectralBatch(limit=1)
+                       for j in xrange(count)]
+            dets = [makeEngine("spectral", batch=batch) for batch in batches]
+            spent = [0.0]
+            for batch in set(batches):
+                batch.run = timedRun(batch.run, spent)
+            start = time.time()
+            for k in xrange(messages):
+                for det in dets:
+                    det.update(msgs[k])
+                if not (k + 1) % poll:
+                    for det in dets:
+                        try:
+                            det.anomalyDetect()
+                        except ZeroDivisionError:
+                            pass        # still warming up
+            elapsed = time.time() - start
+            for k in xrange(messages, messages + poll):
+                for det in dets:
+                    det.update(msgs[k])
+            lost = sum(det.anomalyDetect() for det in dets) / count
+            runs = sum(batch.runs for batch in set(batches))
+            transforms = sum(batch.transforms for batch in set(batches))
+            log.write("%8d %-12s %10d %10d %12.1f %12.3f %8.4f\n" % (count, mode, runs,
+                      transforms, spent[0] / transforms * 1e6,
+                      elapsed / (messages * count) * 1e6, lost))
+
+
+def bench_warmup(messages=3000, poll=100, log=sys.stdout):
+    """Poll a window and a spectral stream together while the spectral one warms up.
+
+    Both streams get the same `messages`, with "window|spectral" polled
+    through GET anomalyDetect every `poll` of them, in each detector
+    layout.  Every poll must succeed ("failed" 0) and answer the window
+    stream once it is warm; the spectral stream is left out until its
+    first transforms, at the sample in "spectral from".
+    """
+
+    log.write("%-10s %8s %8s %8s %10s %14s\n" % ("layout", "polls", "failed", "window",
+              "spectral", "spectral from"))
+    rows = list(motion_messages(messages))
+    for (layout, init) in [("detectors", {}), ("fleet", {"fleet": "1"}),
+                           ("shards", {"workers": "2"})]:
+        r = Replay(["window", "spectral:spectral"], init=init)
+        for name in ("window", "spectral"):
+            r.addStream(name)
+        callbacks = r.app.mo.callbacks
+        polls = failed = 0
+        answered = {"window": 0, "spectral": 0}
+        first = None
+        for (k, dat) in enumerate(rows):
+            for name in ("window", "spectral"):
+                callbacks[name](dat)
+            if (k + 1) % poll:
+                continue
+            polls += 1
+            try:
+                result = r.app.GET(commandType="anomalyDetect", argString="window|spectral")
+            except Exception:
+                failed += 1
+                continue
+            for name in answered:
+                answered[name] += name in result
+            if first is None and "spectral" in result:
+                first = k + 1
+        log.write("%-10s %8d %8d %8d %10d %14s\n" % (layout, polls, failed, answered["window"],
+                  answered["spectral"], first if first is not None else "-"))
+        r.app.shutdown()
+
+
+def bench_idle(specs=("window", "ewma", "quantile"), checks=(100, 1000, 2500, 5000, 10000),
+               log=sys.stdout):
+    """Scores after a stream starts with one idle message, then stationary counts.
+
+    An engine whose averages stay pinned near that first all-zero message
+    reports false anomalies until they forget it; every column should be
+    near 0.5, or "-" while the engine is still warming up.
+    """
+
+    log.write("%-10s" % "engine" + "".join("%10d" % n for n in checks) + "\n")
+    idle = dict((direction, 0) for direction in DIRECTIONS)
+    for spec in specs:
+        (engine, options) = parseEngineSpec("stream:" + spec)[1:]
+        det = makeEngine(engine, **options)
+        det.update(idle)
+        scores = []
+        for (k, msg) in enumerate(motion_messages(max(checks))):
+            det.update(msg)
+            if k + 1 in checks:
+                try:
+                    scores.append("%.3f" % det.anomalyDetect())
+                except ZeroDivisionError:
+                    scores.append("-")      # still warming up
+        log.write("%-10s" % spec + "".join("%10s" % score for score in scores) + "\n")
+
+
+def bench_engines(specs=None, messages=40000, rate=100, log=sys.stdout):
+    """Time every registered detector engine on the same message stream.
+
+    `specs` are "engine" or "engine:opt=val,opt=val" strings, default every
+    registered engine with its default options.  Messages carry timestamps
+    `rate` per second so time-based engines see a realistic clock.
+    """
+
+    if not specs:
+        specs = sorted(ENGINES)
+    msgs = list(motion_messages(messages))
+    for (k, msg) in enumerate(msgs):
+        msg["timestamp"] = float(k) / rate
+    log.write("%-32s %12s %12s %12s %10s\n" % ("engine", "us/msg", "ms/score",
+              "KB", "score"))
+    for spec in specs:
+        (_, engine, options) = parseEngineSpec("bench:" + spec)
+        det = makeEngine(engine, **options)
+        start = time.time()
+        for msg in msgs:
+            det.update(msg)
+        perMsg = (time.time() - start) / len(msgs)
+        try:
+            (score, perScore) = timed(det.anomalyDetect, 5)
+        except ZeroDivisionError:
+            (score, perScore) = (float("nan"), float("nan"))
+        log.write("%-32s %12.3f %12.3f %12.1f %10.4f\n" % (spec, perMsg * 1e6,
+                  perScore * 1000, det.nbytes() / 1e3, score))
+
+
+def bench_cache(windows, rates, tabs=10, period=2, seconds=60, log=sys.stdout):
+    """Score cache hits and poll cost with `tabs` browsers polling every `period` s.
+
+    Each stream receives `rate` messages per second for `seconds`; between
+    messages every tab's poll after the first is answered from the cache.
+    """
+
+    log.write("%10s %8s %8s %8s %14s %14s\n" % ("window", "rate", "hits", "misses",
+              "raw ms/poll", "cached ms/poll"))
+    for window in windows:
+        for rate in rates:
+            msgs = motion_messages(window + rate * seconds)
+            raw = AnomalyDetector(trainSet=window, incremental=False)
+            cached = CachedDetector(AnomalyDetector(trainSet=window, incremental=False))
+            for k in xrange(window):
+                msg = next(msgs)
+                raw.update(msg)
+                cached.update(msg)
+            rawTime = cachedTime = 0.0
+            for second in xrange(seconds):
+                for k in xrange(rate):
+                    msg = next(msgs)
+                    raw.update(msg)
+                    cached.update(msg)
+                if second % period:
+                    continue
+                for tab in xrange(tabs):
+                    rawTime += timed(raw.anomalyDetect, 1)[1]
+                    cachedTime += timed(cached.anomalyDetect, 1)[1]
+            polls = cached.hits + cached.misses
+            log.write("%10d %8d %8d %8d %14.3f %14.3f\n" % (window, rate, cached.hits,
+                      cached.misses, rawTime / polls * 1000, cachedTime / polls * 1000))
+
+
+def bench_shards(workers, streams, messages=20000, log=sys.stdout):
+    """Replay throughput with detectors in 0 (in-process) to N worker processes.
+
+    `messages` messages per stream are replayed as fast as possible through
+    anomalyApp, polling every 2 recording seconds, and the clock stops once
+    a final anomalyDetect has seen every message.  "app us/msg" is the CPU
+    the app process itself spends per message; with a core per worker,
+    throughput is bounded by its inverse rather than by the detectors.
+    """
+
+    log.write("%8s %8s %12s %12s %10s %12s\n" % ("workers", "streams", "msgs/sec",
+              "p50 poll ms", "speedup", "app us/msg"))
+    rows = list(motion_messages(messages))
+    base = None
+    for count in workers:
+        recording = ((k / 10.0, "s%d" % j, rows[k]) for k in xrange(messages)
+                     for j in xrange(streams))
+        r = Replay(init={"workers": str(count)})
+        cpu = sum(os.times()[:2])
+        r.run(recording)
+        start = time.time()
+        r.score(messages / 10.0)
+        elapsed = r.elapsed + time.time() - start
+        cpu = sum(os.times()[:2]) - cpu
+        rate = messages * streams / elapsed
+        base = base or rate
+        log.write("%8d %8d %12.0f %12.3f %9.2fx %12.2f\n" % (count, streams, rate,
+                  r.report()["p50"], rate / base, cpu / (messages * streams) * 1e6))
+        r.app.shutdown()
+
+
+def bench_stress(streams, messages=20000, ingesters=2, scorers=4, log=sys.stdout):
+    """Hammer ingestion and scoring concurrently in each detector layout.
+
+    `ingesters` threads feed `messages` messages to each of `streams`
+    streams through the launchVideo callbacks while `scorers` threads poll
+    anomalyDetect on every stream.  Reports messages the detectors did not
+    apply (lost), exceptions raised in either path, polls that left out a
+    stream still warming up, throughput, and whether the final scores
+    equal those of the same messages fed serially.
+    """
+
+    names = ["s%d" % j for j in xrange(streams)]
+    rows = list(motion_messages(messages))
+    reference = Replay()
+    for name in names:
+        reference.addStream(name)
+        for dat in rows:
+            reference.app.mo.callbacks[name](dat)
+    expected = reference.app.scoreStreams(names)
+    log.write("%-10s %8s %8s %8s %10s %12s %10s %6s\n" % ("layout", "lost", "ingest",
+              "score", "warming", "msgs/sec", "scores/s", "same"))
+    for (layout, init) in [("detectors", {}), ("fleet", {"fleet": "1"}),
+                           ("shards", {"workers": "2"})]:
+        r = Replay(init=init)
+        for name in names:
+            r.addStream(name)
+        app = r.app
+        callbacks = app.mo.callbacks
+        done = threading.Event()
+        counts = {"scores": 0, "errors": 0, "warming": 0}
+
+        def ingest(mine):
+            for dat in rows:
+                for name in mine:
+                    callbacks[name](dat)
+
+        def score():
+            while not done.isSet():
+                try:
+                    if len(app.scoreStreams(names)) < len(names):
+                        counts["warming"] += 1
+                    counts["scores"] += 1
+                except Exception:
+                    counts["errors"] += 1
+
+        feeders = [threading.Thread(target=ingest, args=(names[k::ingesters],))
+                   for k in xrange(ingesters)]
+        pollers = [threading.Thread(target=score) for k in xrange(scorers)]
+        start = time.time()
+        for thread in pollers + feeders:
+            thread.start()
+        for thread in feeders:
+            thread.join()
+        elapsed = time.time() - start
+        done.set()
+        for thread in pollers:
+            thread.join()
+        versions = app.GET(commandType="scoreCacheStats", argString="|".join(names))
+        lost = sum(messages - versions[name]["version"] for name in names)
+        scores = app.scoreStreams(names)
+        same = all(scores[name] == expected[name] for name in names)
+        log.write("%-10s %8d %8d %8d %10d %12.0f %10.1f %6s\n" % (layout, lost,
+                  sum(app.ingestErrors.values()), counts["errors"], counts["warming"],
+                  messages * streams / elapsed, counts["scores"] / elapsed, same))
+        app.shutdown()
+    reference.app.shutdown()
+
+
+def bench_changes(paths=None, specs=("window", "ewma", "median", "cusum"), shift=1.0,
+                  at=0.75, poll=1.0, messages=30000, log=sys.stdout):
+    """Detection delay and false alarms of a step change replayed through each engine.
+
+    The recordings at `paths` (default two synthetic 10 message/s streams,
+    one of uniform and one of bursty counts) are replayed with every count
+    raised by `shift` of its direction's stdevs from fraction `at` of each
+    stream's messages on.  "score delay" is the recording time from the
+    step to the first poll whose anomaly value is 0.25 or more from 0.5,
+    "event delay" the time to the first rise in changeEvents, and "early"
+    the fraction of polls before the step already that far from 0.5.
+    "false/h" is the rate of changeEvents before the step per hour of
+    recording, from the events an engine still holds at the step; both
+    event columns are nan for engines that record none.
+    Delays are medians over streams, rates means.
+    """
+
+    directory = None
+    if not paths:
+        directory = tempfile.mkdtemp(prefix="anomalybench")
+        paths = [os.path.join(directory, "uniform.jsonl"), os.path.join(directory, "bursty.jsonl")]
+        for (path, msgs) in zip(paths, [motion_messages(messages),
+                                        skewed_messages(messages, burst=0.05)]):
+            with open(path, "w") as f:
+                for (k, msg) in enumerate(msgs):
+                    msg["timestamp"] = k / 10.0
+                    f.write(json.dumps(msg) + "\n")
+    recording = list(readRecordings(paths))
+    if directory:
+        shutil.rmtree(directory)
+    byStream = {}
+    for (t, stream, msg) in recording:
+        byStream.setdefault(stream, []).append((t, msg))
+    steps = {}      # stream -> (sample number, time) of the step
+    raised = {}     # stream -> counts added to each direction
+    for (stream, rows) in byStream.items():
+        k = int(len(rows) * at)
+        steps[stream] = (k, rows[k][0])
+        raised[stream] = {}
+        for direction in DIRECTIONS:
+            moments = RunningMoments.fromValues([msg[direction] for (t, msg) in rows[:k]])
+            raised[stream][direction] = max(int(round(shift * moments.stdev())), 1)
+    counts = {}
+    shifted = []
+    stepIndex = set()   # positions in `shifted` of each stream's first raised message
+    for (t, stream, msg) in recording:
+        k = counts.get(stream, 0)
+        counts[stream] = k + 1
+        if k == steps[stream][0]:
+            stepIndex.add(len(shifted))
+        if k >= steps[stream][0]:
+            msg = dict(msg)
+            for direction in DIRECTIONS:
+                msg[direction] += raised[stream][direction]
+        shifted.append((t, stream, msg))
+
+    log.write("%-10s %8s %10s %14s %14s %8s %8s\n" % ("engine", "streams", "us/msg",
+              "score delay s", "event delay s", "early", "false/h"))
+    for spec in specs:
+        r = Replay(["%s:%s" % (stream, spec) for stream in byStream], poll=poll)
+        before = {}     # stream -> change events held when its step starts
+
+        def messages():
+            for (i, item) in enumerate(shifted):
+                if i in stepIndex:
+                    before[item[1]] = r.app.GET(commandType="changeEvents",
+                                                argString=item[1])[item[1]]
+                yield item
+
+        cpu = sum(os.times()[:2])
+        r.run(messages())
+        cpu = sum(os.times()[:2]) - cpu
+        scoreDelays = []
+        eventDelays = []
+        early = polls = 0
+        falseAlarms = hours = 0.0
+        recorded = False
+        for stream in byStream:
+            (k, tc) = steps[stream]
+            found = None
+            for (t, scores) in r.series:
+                if stream not in scores:
+                    continue
+                alarm = abs(scores[stream] - 0.5) >= 0.25
+                if t < tc:
+                    polls += 1
+                    early += alarm
+                elif alarm and found is None:
+                    found = t - tc
+            scoreDelays.append(found if found is not None else float("inf"))
+            changes = r.app.GET(commandType="changeEvents", argString=stream,
+                                since=k - 1)[stream]
+            recorded = recorded or bool(changes or before[stream])
+            rises = [c["sample"] for c in changes if c["change"] == "rise"]
+            rows = byStream[stream]
+            eventDelays.append(rows[min(rises)][0] - tc if rises else float("nan"))
+            falseAlarms += len(before[stream])
+            hours += (tc - rows[0][0]) / 3600.0
+        log.write("%-10s %8d %10.2f %14.1f %14.1f %8.3f %8.2f\n" % (spec, len(byStream),
+                  cpu / len(shifted) * 1e6, sorted(scoreDelays)[len(scoreDelays) / 2],
+                  sorted(eventDelays)[len(eventDelays) / 2], early / float(max(polls, 1)),
+                  falseAlarms / hours if recorded and hours else float("nan")))
+        r.app.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="anomalyApp detector benchmarks")
+    parser.add_argument("bench", choices=["incremental", "history", "fleet", "zprob",
+                        "moments", "time", "quantile", "median", "divergence", "markov", "spectral", "warmup", "idle",
+                        "engines", "cache", "mapped", "shards", "stress", "changes"])
+    parser.add_argument("--windows", default="1000,10000,100000,1000000",
+                        help="comma separated window sizes (trainSet)")
+    parser.add_argument("--scores", type=int, default=20,
+                        help="number of timed update+score rounds")
+    parser.add_argument("--streams", default="10,100,1000",
+                        help="comma separated stream counts (fleet, mapped, spectral; "
+                        "shards and stress use the first)")
+    parser.add_argument("--workers", default="0,1,2,4",
+                        help="comma separated worker process counts (shards)")
+    parser.add_argument("--engines", default="",
+                        help="comma separated engine specs, engine:opt=val;opt=val "
+                        "(engines, default every registered engine)")
+    parser.add_argument("--rates", default="10,100,1000",
+                        help="comma separated message rates per second (time, cache)")
+    parser.add_argument("--recordings", default="",
+                        help="glob of JSONL recordings to replay (changes, default synthetic)")
+    parser.add_argument("--fill", type=int, default=1000,
+                        help="messages per stream before scoring (fleet)")
+    args = parser.parse_args()
+
+    windows = [int(w) for w in args.windows.split(",")]
+    if args.bench == "incremental":
+        bench_incremental(windows, scores=args.scores)
+    elif args.bench == "history":
+        bench_history(windows)
+    elif args.bench == "fleet":
+        bench_fleet(windows, [int(c) for c in args.streams.split(",")],
+                    fill=args.fill)
+    elif args.bench == "zprob":
+        bench_zprob()
+    elif args.bench == "moments":
+        bench_moments(windows)
+    elif args.bench == "time":
+        bench_time([int(r) for r in args.rates.split(",")])
+    elif args.bench == "quantile":
+        bench_quantile(windows)
+    elif args.bench == "median":
+        bench_median(windows)
+    elif args.bench == "divergence":
+        bench_divergence(windows)
+    elif args.bench == "markov":
+        bench_markov(windows)
+    elif args.bench == "spectral":
+        bench_spectral([int(c) for c in args.streams.split(",")])
+    elif args.bench == "warmup":
+        bench_warmup()
+    elif args.bench == "idle":
+        bench_idle()
+    elif args.bench == "engines":
+        bench_engines([spec.replace(";", ",") for spec in args.engines.split(",") if spec])
+    elif args.bench == "stress":
+        bench_stress(int(args.streams.split(",")[0]))
+    elif args.bench == "shards":
+        bench_shards([int(w) for w in args.workers.split(",")],
+                     int(args.streams.split(",")[0]))
+    elif args.bench == "mapped":
+        bench_mapped(windows, [int(c) for c in args.streams.split(",")])
+    elif args.bench == "changes":
+        bench_changes(sorted(glob.glob(args.recordings)) if args.recordings else None)
+    elif args.bench == "cache":
+        bench_cache(windows, [int(r) for r in args.rates.split(",")])
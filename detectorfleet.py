@@ -0,0 +1,268 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+detectorfleet.py
+
+Columnar motion history for many streams, scored in one vectorized pass.
+
+:class:`DetectorFleet` holds the histories of every stream in a single
+(streams x window x 4) uint16 array instead of one :class:`anomalyApp.AnomalyDetector`
+per stream.  Training and test sums are moved incrementally as rows arrive
+and leave, and :meth:`DetectorFleet.anomalyDetect` computes the means,
+stdevs, test means and z-probabilities of all requested streams at once.
+Scores match ``AnomalyDetector.anomalyDetect()`` for the same messages.
+Each stream carries a version counter that advances on update, and only
+streams whose version changed since their last score are recomputed.
+
+Each stream has its own lock, held while a message is applied and while
+a score pass copies that stream's sums, so scores never see a
+half-applied message and ingestion of one stream never waits on another.
+
+Requires numpy.
+"""
+
+import struct
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from motionstats import zprobs
+
+
+class DetectorFleet(object):
+
+    """Motion histories and window sums for a fleet of streams.
+
+    :param trainSet: window size, as for AnomalyDetector.  Default: ``20000``
+    :param streams: initial stream capacity, doubled as streams are added.  Default: ``64``
+    :param zTable: optional motionstats.ZProbTable for the probability conversion.  Default: ``None``
+    """
+
+    def __init__(self, trainSet=20000, streams=64, zTable=None):
+        if numpy is None:
+            raise ImportError("DetectorFleet requires numpy")
+        self.ts = trainSet
+        self.zprobs = zTable.zprobs if zTable is not None else zprobs
+        self.rows = {}
+        self.history = numpy.zeros((streams, trainSet, 4), numpy.uint16)
+        self.limit = int(numpy.iinfo(numpy.uint16).max)
+        self.trainSum = numpy.zeros((streams, 4))
+        self.trainSq = numpy.zeros((streams, 4))
+        self.testSum = numpy.zeros((streams, 4))
+        # per-stream ring position and window bounds, in absolute sample
+        # numbers as in motionstats.SplitWindow
+        self.start = []
+        self.length = []
+        self.first = []
+        self.bounds = []
+        # per-stream version, last (version, score) and cache counters
+        self.version = []
+        self.cached = []
+        self.hits = []
+        self.misses = []
+        self.locks = []         # per-stream state locks
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def addStream(self, name):
+        """Reserve a row for stream `name`, growing the store if needed."""
+
+        if name in self.rows:
+            return self.rows[name]
+        row = len(self.rows)
+        if row == self.history.shape[0]:
+            # no stream may be written while the arrays are copied
+            for lock in self.locks:
+                lock.acquire()
+            try:
+                self._grow(2 * row)
+            finally:
+                for lock in self.locks:
+                    lock.release()
+        self.locks.append(threading.Lock())
+        self.start.append(0)
+        self.length.append(0)
+        self.first.append(0)
+        self.bounds.append([0, 0, 0, 0])
+        self.version.append(0)
+        self.cached.append(None)
+        self.hits.append(0)
+        self.misses.append(0)
+        self.rows[name] = row
+        return row
+
+    def _grow(self, streams):
+        def grown(a):
+            b = numpy.zeros((streams,) + a.shape[1:], a.dtype)
+            b[:a.shape[0]] = a
+            return b
+        self.history = grown(self.history)
+        self.trainSum = grown(self.trainSum)
+        self.trainSq = grown(self.trainSq)
+        self.testSum = grown(self.testSum)
+
+    def update(self, name, dat):
+        """Add one DetectMovement message to stream `name`."""
+
+        i = self.rows[name]
+        with self.locks[i]:
+            slot = (self.start[i] + self.length[i]) % self.ts
+            # clamped as motionstats.MotionHistory clamps; numpy would wrap
+            # negative and too large counts and truncate floats silently
+            limit = self.limit
+            self.history[i, slot] = [min(max(int(dat[key]), 0), limit)
+                                     for key in ("nRight", "nLeft", "nUp", "nDown")]
+            self.length[i] += 1
+            evict = self.length[i] == self.ts
+            self._slide(i, self.first[i] + evict, self.length[i] - evict)
+            if evict:
+                self.start[i] = (self.start[i] + 1) % self.ts
+                self.length[i] -= 1
+                self.first[i] += 1
+            self.version[i] += 1
+
+    def _row(self, i, x):
+        slot = (self.start[i] + x - self.first[i]) % self.ts
+        return self.history[i, slot].astype(numpy.float64)
+
+    def _slide(self, i, first, n):
+        # same boundary moves as motionstats.SplitWindow.slide
+        (oldTrainLo, oldTrainHi, oldTestLo, oldTestHi) = self.bounds[i]
+        testingIndex = (9 * n) / 10
+        trainLo, trainHi = first, first + testingIndex
+        testLo, testHi = trainHi + 1, max(trainHi + 1, first + n)
+        for x in xrange(max(oldTrainHi, trainLo), trainHi):
+            r = self._row(i, x)
+            self.trainSum[i] += r
+            self.trainSq[i] += r * r
+        for x in xrange(oldTrainLo, min(oldTrainHi, trainLo)):
+            r = self._row(i, x)
+            self.trainSum[i] -= r
+            self.trainSq[i] -= r * r
+        for x in xrange(max(oldTestHi, testLo), testHi):
+            self.testSum[i] += self._row(i, x)
+        for x in xrange(oldTestLo, min(oldTestHi, testLo)):
+            self.testSum[i] -= self._row(i, x)
+        self.bounds[i] = [trainLo, trainHi, testLo, testHi]
+
+    def anomalyDetect(self, names=None):
+        """Score streams `names` (default: all), reusing unchanged scores.
+
+        Returns a dict of stream name -> AnomalyDetector.anomalyDetect()
+        score.  Streams without enough samples to score map to None.
+        Streams updated since their last score are recomputed together
+        in one vectorized pass; concurrent callers wait for it rather
+        than repeat it.
+        """
+
+        if names is None:
+            names = list(self.rows)
+        scores = {}
+        stale = []
+        for name in names:
+            i = self.rows[name]
+            cached = self.cached[i]
+            if cached is not None and cached[0] == self.version[i]:
+                self.hits[i] += 1
+                scores[name] = cached[1]
+            else:
+                stale.append(name)
+        if stale:
+            with self.lock:
+                fresh = []
+                for name in stale:
+                    i = self.rows[name]
+                    cached = self.cached[i]
+                    if cached is not None and cached[0] == self.version[i]:
+                        self.hits[i] += 1
+                        scores[name] = cached[1]
+                    else:
+                        self.misses[i] += 1
+                        fresh.append(name)
+                (computed, versions) = self._score(fresh)
+                for (name, version) in zip(fresh, versions):
+                    self.cached[self.rows[name]] = (version, computed[name])
+                scores.update(computed)
+        return scores
+
+    def score(self, names):
+        """Score streams `names` in one vectorized pass, without the cache."""
+
+        return self._score(names)[0]
+
+    def _score(self, names):
+        # returns the scores and the version of each stream they were taken at
+        idx = numpy.array([self.rows[name] for name in names], numpy.intp)
+        order = sorted(set(idx.tolist()))
+        for i in order:
+            self.locks[i].acquire()
+        try:
+            versions = [self.version[i] for i in idx]
+            bounds = numpy.array([self.bounds[i] for i in idx], numpy.float64).reshape(-1, 4)
+            s = self.trainSum[idx]
+            S = self.trainSq[idx]
+            t = self.testSum[idx]
+        finally:
+            for i in order:
+                self.locks[i].release()
+        n = (bounds[:, 1] - bounds[:, 0])[:, None]
+        counter = (bounds[:, 3] - bounds[:, 2])[:, None]
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            mean = s / n
+            stdev = numpy.sqrt((n * S - s ** 2) / (n * (n - 1)))
+            testMean = t / counter
+            z = (testMean - mean) / stdev
+            scores = self.zprobs(z).sum(axis=1) / 4.0
+        ok = numpy.isfinite(z).all(axis=1)
+        return (dict((name, float(scores[k]) if ok[k] else None)
+                     for (k, name) in enumerate(names)), versions)
+
+    def pack(self, name):
+        """Stream `name`'s rows, in motionstats.SplitWindow.pack() format."""
+
+        i = self.rows[name]
+        with self.locks[i]:
+            (start, length, first) = (self.start[i], self.length[i], self.first[i])
+            slots = (start + numpy.arange(length)) % self.ts
+            return struct.pack("<q", first) + self.history[i, slots].tostring()
+
+    def restore(self, name, data):
+        """Load SplitWindow.pack() output into stream `name` and rebuild its sums."""
+
+        i = self.rows[name]
+        first = struct.unpack("<q", data[:8])[0]
+        rows = numpy.frombuffer(data[8:], numpy.uint16).reshape(-1, 4)
+        # keep the trainSet-1 rows update() would have kept
+        kept = rows[-(self.ts - 1):] if len(rows) else rows
+        first += len(rows) - len(kept)
+        with self.locks[i]:
+            self.history[i, :len(kept)] = kept
+            self.start[i] = 0
+            self.length[i] = len(kept)
+            self.first[i] = first
+            self.trainSum[i] = self.trainSq[i] = self.testSum[i] = 0.0
+            self.bounds[i] = [first] * 4
+            self._slide(i, first, len(kept))
+            self.version[i] += 1
+
+    def stats(self, name):
+        """Version and score cache counters of stream `name`."""
+
+        i = self.rows[name]
+        return {"version": self.version[i], "hits": self.hits[i],
+                "misses": self.misses[i]}
+
+    def nbytes(self):
+        """Bytes used by the columnar arrays."""
+
+        return (self.history.nbytes + self.trainSum.nbytes + self.trainSq.nbytes
+                + self.testSum.nbytes)
@@ -0,0 +1,1268 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+detectors.py
+
+Detector engines for :mod:`anomalyApp` and the registry they are chosen from.
+
+Each engine implements :class:`DetectorEngine`.  It takes DetectMovement
+messages through ``update(dat)`` and returns a score through
+``anomalyDetect()`` on the same scale as ``anomalyApp.AnomalyDetector``:
+the mean over the four directions of the probability that the recent
+motion is below the baseline's, so 0.5 is normal and values near 0 or 1
+are anomalous.
+
+Engines are registered by name with :func:`registerEngine` and built with
+:func:`makeEngine`.  A stream's engine is given to addVideo as
+``stream:engine:option=value,option=value``, parsed by :func:`parseEngineSpec`.
+"""
+
+import copy
+import math
+import time
+import struct
+import inspect
+import threading
+from array import array
+from collections import deque
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from motionstats import DIRECTIONS, CountTree, EwmaMoments, MappedHistory, P2Histogram, \
+    SplitWindow, sampleTime, zprob
+
+
+# engine name -> (factory, default options)
+ENGINES = {}
+
+
+def registerEngine(name, factory, **defaults):
+    """Register detector engine `factory` under `name` with default options."""
+
+    ENGINES[name] = (factory, defaults)
+
+
+def engineOptions(name):
+    """Names of the keyword options engine `name` accepts."""
+
+    factory = ENGINES[name][0]
+    init = factory.__init__ if inspect.isclass(factory) else factory
+    return inspect.getargspec(init).args
+
+
+def makeEngine(name, **options):
+    """Build engine `name`; `options` override its registered defaults."""
+
+    if name not in ENGINES:
+        raise ValueError("Unknown detector engine: %s" % name)
+    (factory, defaults) = ENGINES[name]
+    params = dict(defaults)
+    params.update(options)
+    return factory(**params)
+
+
+def parseValue(value):
+    # option values arrive as strings in the addVideo argString
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    if value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    return value
+
+
+def parseEngineSpec(spec, engine="window"):
+    """Split "stream:engine:opt=val,opt=val" into (stream, engine, options).
+
+    The engine and options are optional; `engine` is the default engine.
+    """
+
+    parts = spec.split(":", 2)
+    name = parts[0]
+    if len(parts) > 1 and parts[1]:
+        engine = parts[1]
+    options = {}
+    if len(parts) > 2 and parts[2]:
+        for option in parts[2].split(","):
+            (key, _, value) = option.partition("=")
+            options[key.strip()] = parseValue(value.strip())
+    return (name, engine, options)
+
+
+def zprobFor(zTable):
+    """zTable's zprob, or motionstats.zprob without a table."""
+
+    return zTable.zprob if zTable is not None else zprob
+
+
+class DetectorEngine(object):
+
+    """Interface shared by all detector engines.
+
+    update(dat) adds one DetectMovement message, anomalyDetect() returns
+    the current score, nbytes() the bytes held by the engine's state and
+    reset() forgets every message seen so far.  pack() serializes that
+    state to bytes and restore(data) loads it into an engine built with
+    the same options, raising ValueError if it does not fit.
+
+    changes(since) lists the change points detected after sample number
+    `since`; engines that do not detect change points have none.
+
+    packSidecar() returns the bytes of state an engine keeps in a file of
+    its own, such as a seasonal profile, for the snapshot pass to write;
+    None for engines that keep none.
+    """
+
+    def update(self, dat):
+        raise NotImplementedError
+
+    def anomalyDetect(self):
+        raise NotImplementedError
+
+    def nbytes(self):
+        raise NotImplementedError
+
+    def reset(self):
+        raise NotImplementedError
+
+    def pack(self):
+        raise NotImplementedError
+
+    def restore(self, data):
+        raise NotImplementedError
+
+    def changes(self, since=-1):
+        return []
+
+    def packSidecar(self):
+        return None
+
+
+class CachedDetector(DetectorEngine):
+
+    """Memoizes an engine's score against a version counter.
+
+    The version advances on every update(), so polls between messages get
+    the cached score.  Requests that arrive while a score is being
+    computed wait for it instead of computing their own.  `hits` and
+    `misses` count the polls served from and not from the cache; they
+    and the cached score are guarded by `lock`.
+
+    The engine's state is guarded by `stateLock`, a lock per stream:
+    update(), scoring, pack() and restore() each hold it, so a score or
+    snapshot never sees a half-applied message and streams never wait on
+    each other.  Scorers queue on `lock` first, so a burst of polls holds
+    up ingestion for one computation at most.
+
+    :param engine: the DetectorEngine to wrap
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.version = 0
+        self.cached = None      # (version, score)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.stateLock = threading.Lock()
+
+    def update(self, dat):
+        with self.stateLock:
+            self.engine.update(dat)
+            self.version += 1
+
+    def anomalyDetect(self):
+        # the counters are only touched under `lock`, so concurrent polls
+        # never lose an increment
+        with self.lock:
+            # a request ahead of us may have just computed it
+            cached = self.cached
+            if cached is not None and cached[0] == self.version:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+            with self.stateLock:
+                version = self.version
+                score = self.engine.anomalyDetect()
+            self.cached = (version, score)
+            return score
+
+    def nbytes(self):
+        return self.engine.nbytes()
+
+    def reset(self):
+        with self.stateLock:
+            self.engine.reset()
+            self.version += 1
+
+    def pack(self):
+        with self.stateLock:
+            return self.engine.pack()
+
+    def restore(self, data):
+        with self.stateLock:
+            self.engine.restore(data)
+            self.version += 1
+
+    def changes(self, since=-1):
+        with self.stateLock:
+            return self.engine.changes(since)
+
+    def packSidecar(self):
+        with self.stateLock:
+            return self.engine.packSidecar()
+
+    def stats(self):
+        """Version and cache counters, for the scoreCacheStats command."""
+
+        return {"version": self.version, "hits": self.hits, "misses": self.misses}
+
+
+class WindowDetector(DetectorEngine):
+
+    """Base for engines that keep a statistic of AnomalyDetector's sliding window.
+
+    Owns the motionstats.SplitWindow, and its MappedHistory with a `path`,
+    feeds it every message and packs and restores it.  A subclass keeps
+    its statistic in trainRow(row, sign) and testRow(row, sign), which the
+    window calls as rows enter and leave each part, clears it in
+    resetParts(), and scores it in anomalyDetect().  restore() rebuilds
+    the statistic row by row from the restored window.
+
+    :param trainSet: window size, as for AnomalyDetector.  Default: ``20000``
+    :param zTable: optional motionstats.ZProbTable.  Default: ``None``
+    :param path: keep the window in this motionstats.MappedHistory file.  Default: ``None``
+    """
+
+    def __init__(self, trainSet=20000, zTable=None, path=None):
+        self.zprob = zprobFor(zTable)
+        self.resetParts()
+        history = MappedHistory(path, trainSet) if path else None
+        self.window = SplitWindow(trainSet, self.trainRow, self.testRow, history)
+
+    def resetParts(self):
+        raise NotImplementedError
+
+    def trainRow(self, row, sign):
+        raise NotImplementedError
+
+    def testRow(self, row, sign):
+        raise NotImplementedError
+
+    def reset(self):
+        self.resetParts()
+        self.window.reset()
+
+    def update(self, dat):
+        self.window.append([dat["nRight"], dat["nLeft"], dat["nUp"], dat["nDown"]])
+
+    def nbytes(self):
+        return self.window.history.nbytes()
+
+    def pack(self):
+        return self.window.pack()
+
+    def restore(self, data):
+        self.resetParts()
+        self.window.restore(data)
+
+
+class EwmaDetector(DetectorEngine):
+
+    """Detector on exponentially weighted moments, O(1) memory per stream.
+
+    Tracks a slow baseline mean/variance and a fast signal mean per
+    direction, and scores the signal mean against the baseline as
+    AnomalyDetector scores its test window against its training window.
+    The default half-lives give the two averages roughly the sample age
+    of the 18000-sample training and 2000-sample test windows of
+    ``AnomalyDetector(trainSet=20000)``.
+
+    As the training window leaves out the test window, the signal is
+    scored against a copy of the baseline taken between `lag` and
+    2*`lag` samples earlier (the first copy until there is one that old),
+    so a step is not absorbed into the mean and variance it is measured
+    against while the signal is still moving to it.  The detector is
+    warming up until the first copy, after `lag` samples.
+
+    :param halflife: baseline half-life in samples.  Default: ``6000``
+    :param signal: signal half-life in samples.  Default: ``700``
+    :param lag: samples between baseline copies.  Default: ``None`` (3 * `signal`)
+    :param zTable: optional motionstats.ZProbTable.  Default: ``None``
+    """
+
+    def __init__(self, halflife=6000, signal=700, lag=None, zTable=None):
+        self.halflife = halflife
+        self.signalHalflife = signal
+        self.lag = int(lag) if lag is not None else int(3 * float(signal))
+        self.zprob = zprobFor(zTable)
+        self.reset()
+
+    def reset(self):
+        # warm, so a first idle message does not pin the means for several half-lives
+        self.baseline = [EwmaMoments(self.halflife, warm=True) for d in DIRECTIONS]
+        self.signal = [EwmaMoments(self.signalHalflife, warm=True) for d in DIRECTIONS]
+        # baseline copies: the one scored against, and the one taken since
+        self.lagged = None
+        self.pending = None
+
+    def nbytes(self):
+        # count, mean and variance per moment
+        copies = len([m for m in (self.lagged, self.pending) if m is not None])
+        return 24 * (len(self.baseline) + len(self.signal) + 4 * copies)
+
+    def update(self, dat):
+        for (j, direction) in enumerate(DIRECTIONS):
+            x = dat[direction]
+            self.baseline[j].update(x)
+            self.signal[j].update(x)
+        if not self.baseline[0].n % self.lag:
+            self.lagged = self.pending
+            self.pending = [copy.copy(m) for m in self.baseline]
+
+    def anomalyDetect(self):
+        baseline = self.lagged or self.pending
+        if baseline is None:
+            raise ZeroDivisionError("no baseline copy before %d samples" % self.lag)
+        total = 0.0
+        for j in xrange(4):
+            total += self.zprob(baseline[j].z(self.signal[j].mean()))
+        return total / 4.0
+
+    def pack(self):
+        copies = [m for m in (self.pending, self.lagged) if m is not None]
+        return "".join(m.pack() for m in self.baseline + self.signal + sum(copies, []))
+
+    def restore(self, data):
+        size = EwmaMoments.PACKED.size
+        if len(data) not in (8 * size, 12 * size, 16 * size):
+            raise ValueError("EwmaDetector snapshot has %d bytes" % len(data))
+        count = len(data) / size
+        # baseline, signal, then the baseline copies taken so far
+        halflives = [self.halflife] * 4 + [self.signalHalflife] * 4 + [self.halflife] * (count - 8)
+        moments = [EwmaMoments.unpack(data[k * size:(k + 1) * size], halflives[k], warm=True)
+                   for k in xrange(count)]
+        self.baseline = moments[:4]
+        self.signal = moments[4:8]
+        self.pending = moments[8:12] or None
+        self.lagged = moments[12:16] or None
+
+
+class TimeWindowDetector(DetectorEngine):
+
+    """Detector with train/test windows measured in seconds.
+
+    Samples are pre-aggregated into one bucket per second holding the
+    count, sum and sum of squares of each direction.  The test window is
+    the last `test` seconds and the training window the `train` seconds
+    before it; window totals move by whole buckets as seconds pass, so
+    memory and scoring cost depend on the window duration, not on how
+    fast the pipeline publishes.
+
+    Samples are placed by ``dat[timeKey] * timeScale`` when present, and
+    by arrival time otherwise.  Late samples still inside the windows are
+    added to their second, older ones are dropped.
+
+    :param train: training window in seconds.  Default: ``540``
+    :param test: test window in seconds.  Default: ``60``
+    :param timeKey: message field holding the sample time.  Default: ``'timestamp'``
+    :param timeScale: factor converting that field to seconds.  Default: ``1.0``
+    :param clock: arrival-time source.  Default: ``time.time``
+    :param zTable: optional motionstats.ZProbTable.  Default: ``None``
+    """
+
+    def __init__(self, train=540, test=60, timeKey="timestamp", timeScale=1.0,
+                 clock=time.time, zTable=None):
+        self.train = int(train)
+        self.test = int(test)
+        self.size = self.train + self.test
+        self.timeKey = timeKey
+        self.timeScale = timeScale
+        self.clock = clock
+        self.zprob = zprobFor(zTable)
+        self.reset()
+
+    def reset(self):
+        self.now = None
+        self.count = array("d", [0.0]) * self.size
+        self.sums = array("d", [0.0]) * (self.size * 4)
+        self.sqs = array("d", [0.0]) * (self.size * 4)
+        # window totals: count, then four sums, then four sums of squares
+        self.trainTotal = [0.0] * 9
+        self.testTotal = [0.0] * 9
+        self.dropped = 0
+
+    def _bucket(self, second):
+        k = second % self.size
+        return ([self.count[k]] + list(self.sums[k * 4:k * 4 + 4])
+                + list(self.sqs[k * 4:k * 4 + 4]))
+
+    def _advance(self, second):
+        if second - self.now >= self.size:
+            # idle longer than both windows: nothing survives but the
+            # count of late samples
+            (now, dropped) = (second, self.dropped)
+            self.reset()
+            (self.now, self.dropped) = (now, dropped)
+            return
+        while self.now < second:
+            self.now += 1
+            expired = self._bucket(self.now - self.size)
+            aged = self._bucket(self.now - self.test)
+            for i in xrange(9):
+                self.trainTotal[i] += aged[i] - expired[i]
+                self.testTotal[i] -= aged[i]
+            k = self.now % self.size
+            self.count[k] = 0.0
+            self.sums[k * 4:k * 4 + 4] = array("d", [0.0]) * 4
+            self.sqs[k * 4:k * 4 + 4] = array("d", [0.0]) * 4
+
+    def update(self, dat):
+        t = sampleTime(dat, self.timeKey, self.timeScale, self.clock)
+        second = int(math.floor(t))
+        if self.now is None:
+            self.now = second
+        elif second > self.now:
+            self._advance(second)
+        age = self.now - second
+        if age >= self.size:
+            self.dropped += 1
+            return
+        total = self.testTotal if age < self.test else self.trainTotal
+        k = second % self.size
+        self.count[k] += 1
+        total[0] += 1
+        for (j, direction) in enumerate(DIRECTIONS):
+            x = dat[direction]
+            self.sums[k * 4 + j] += x
+            self.sqs[k * 4 + j] += x * x
+            total[1 + j] += x
+            total[5 + j] += x * x
+
+    def nbytes(self):
+        """Bytes used by the per-second buckets."""
+
+        return self.count.itemsize * (len(self.count) + len(self.sums) + len(self.sqs))
+
+    # current second (or -1 before the first sample), dropped count, window sizes
+    PACKED = struct.Struct("<qqqq")
+
+    def pack(self):
+        now = self.now if self.now is not None else -1
+        return (self.PACKED.pack(now, self.dropped, self.train, self.test)
+                + self.count.tostring() + self.sums.tostring() + self.sqs.tostring())
+
+    def restore(self, data):
+        size = self.PACKED.size
+        (now, dropped, train, test) = self.PACKED.unpack(data[:size])
+        if (train, test) != (self.train, self.test):
+            raise ValueError("TimeWindowDetector snapshot has train=%d, test=%d" % (train, test))
+        self.reset()
+        buckets = array("d")
+        buckets.fromstring(data[size:])
+        n = self.size
+        if len(buckets) != 9 * n:
+            raise ValueError("TimeWindowDetector snapshot has %d buckets" % (len(buckets) / 9))
+        self.count = buckets[:n]
+        self.sums = buckets[n:5 * n]
+        self.sqs = buckets[5 * n:]
+        self.dropped = dropped
+        self.now = now if now >= 0 else None
+        if self.now is None:
+            return
+        # window totals are recomputed from the buckets so they always agree
+        for second in xrange(self.now - n + 1, self.now + 1):
+            total = self.testTotal if self.now - second < self.test else self.trainTotal
+            bucket = self._bucket(second)
+            for i in xrange(9):
+                total[i] += bucket[i]
+
+    def anomalyDetect(self):
+        n = self.trainTotal[0]
+        counter = self.testTotal[0]
+        total = 0.0
+        for j in xrange(4):
+            s = self.trainTotal[1 + j]
+            S = self.trainTotal[5 + j]
+            mean = s / n
+            stdev = math.sqrt((n * S - s ** 2) / (n * (n - 1)))
+            total += self.zprob((self.testTotal[1 + j] / counter - mean) / stdev)
+        return total / 4.0
+
+
+class MahalanobisDetector(WindowDetector):
+
+    """Covariance-aware detector on AnomalyDetector's sliding window.
+
+    Keeps the training part's mean vector and the inverse of its 4x4
+    scatter matrix current with rank-one Sherman-Morrison updates as rows
+    enter and leave, and scores the test-window mean by its Mahalanobis
+    distance from the training mean.  Correlated shifts, such as right and
+    left motion rising together, count as one larger deviation instead of
+    being averaged away.  Each message and each score cost O(d^2) with
+    d = 4; the inverse is never refactorized.
+
+    The score is zprob of the distance: 0.5 on the training mean, rising
+    toward 1 as the test mean moves away in any direction.
+
+    :param trainSet: window size, as for AnomalyDetector.  Default: ``20000``
+    :param ridge: added to the scatter diagonal so the inverse exists from
+                  the first sample, in counts squared.  Default: ``1.0``
+    :param zTable: optional motionstats.ZProbTable.  Default: ``None``
+    :param path: keep the window in this motionstats.MappedHistory file.  Default: ``None``
+    """
+
+    def __init__(self, trainSet=20000, ridge=1.0, zTable=None, path=None):
+        self.ridge = float(ridge)
+        WindowDetector.__init__(self, trainSet, zTable, path)
+
+    def resetParts(self):
+        self.testSum = [0.0] * 4
+        self.resetTraining()
+
+    def resetTraining(self):
+        self.n = 0
+        self.mean = [0.0] * 4
+        # inverse of (scatter + ridge*I) of the training rows
+        self.P = [[(1.0 / self.ridge if i == j else 0.0) for j in xrange(4)]
+                  for i in xrange(4)]
+
+    def trainRow(self, row, sign):
+        if sign > 0:
+            self.n += 1
+            delta = [row[i] - self.mean[i] for i in xrange(4)]
+            self.mean = [self.mean[i] + delta[i] / float(self.n) for i in xrange(4)]
+            self.rankOne(delta, (self.n - 1) / float(self.n))
+        elif self.n <= 1:
+            self.resetTraining()
+        else:
+            self.n -= 1
+            delta = [row[i] - self.mean[i] for i in xrange(4)]
+            self.mean = [self.mean[i] - delta[i] / float(self.n) for i in xrange(4)]
+            self.rankOne(delta, -(self.n + 1) / float(self.n))
+
+    def rankOne(self, u, c):
+        # Sherman-Morrison for scatter += c*u*u^T; P is symmetric
+        P = self.P
+        Pu = [P[i][0] * u[0] + P[i][1] * u[1] + P[i][2] * u[2] + P[i][3] * u[3]
+              for i in xrange(4)]
+        k = c / (1.0 + c * (u[0] * Pu[0] + u[1] * Pu[1] + u[2] * Pu[2] + u[3] * Pu[3]))
+        self.P = [[P[i][j] - k * Pu[i] * Pu[j] for j in xrange(4)] for i in xrange(4)]
+
+    def testRow(self, row, sign):
+        self.testSum = [self.testSum[i] + sign * row[i] for i in xrange(4)]
+
+    def distance(self):
+        """Mahalanobis distance of the test-window mean from the training mean."""
+
+        if self.n < 2:
+            raise ZeroDivisionError("covariance of fewer than 2 samples")
+        counter = float(self.window.testCount())
+        d = [self.testSum[i] / counter - self.mean[i] for i in xrange(4)]
+        P = self.P
+        d2 = sum(d[i] * P[i][j] * d[j] for i in xrange(4) for j in xrange(4))
+        return math.sqrt(max(d2 * (self.n - 1), 0.0))
+
+    def anomalyDetect(self):
+        return self.zprob(self.distance())
+
+
+# fractional part of the golden ratio, for low-discrepancy dithering
+GOLDEN = 0.6180339887498949
+
+
+class QuantileDetector(DetectorEngine):
+
+    """Distribution-free detector on streaming quantile sketches.
+
+    DetectMovement counts are bursty and far from Gaussian, so instead of
+    a z-score this engine keeps a fixed-size P^2 histogram of each
+    direction and places every sample by its empirical tail position in
+    that histogram (0.5 at the median, near 0 or 1 in the tails).  The
+    score is the exponentially weighted mean of those positions, as in
+    EwmaDetector, so it stays near 0.5 on stationary data however skewed
+    the counts are; the tail position of a mean would not.
+
+    The baseline sketch is rebuilt every `epoch` samples: a new sketch
+    fills while the last complete one is used for scoring.  Integer
+    counts are dithered by a uniform offset in [-0.5, 0.5) before they
+    enter the sketch so ties do not collapse its markers.
+
+    :param epoch: samples per baseline sketch.  Default: ``18000``
+    :param signal: half-life in samples of the mean tail position.  Default: ``700``
+    :param cells: P^2 histogram cells per direction.  Default: ``16``
+    :param dither: dither integer counts.  Default: ``True``
+    """
+
+    def __init__(self, epoch=18000, signal=700, cells=16, dither=True):
+        self.epoch = int(epoch)
+        self.cells = int(cells)
+        self.dither = dither
+        self.signalHalflife = signal
+        self.reset()
+
+    def reset(self):
+        self.offset = 0.0
+        self.current = [P2Histogram(self.cells) for d in DIRECTIONS]
+        self.previous = None
+        self.signal = [EwmaMoments(self.signalHalflife, warm=True) for d in DIRECTIONS]
+
+    def update(self, dat):
+        offset = 0.0
+        if self.dither:
+            self.offset = (self.offset + GOLDEN) % 1.0
+            offset = self.offset - 0.5
+        baseline = self.baseline()
+        for (j, direction) in enumerate(DIRECTIONS):
+            x = dat[direction]
+            self.current[j].update(x + offset)
+            self.signal[j].update(baseline[j].cdf(x))
+        if self.current[0].n >= self.epoch:
+            self.previous = self.current
+            self.current = [P2Histogram(self.cells) for d in DIRECTIONS]
+
+    def baseline(self):
+        if self.previous is None:
+            return self.current
+        return self.previous
+
+    def anomalyDetect(self):
+        total = 0.0
+        for j in xrange(4):
+            total += self.signal[j].mean()
+        return total / 4.0
+
+    def nbytes(self):
+        sketches = self.current + (self.previous or [])
+        return sum(sketch.nbytes() for sketch in sketches) + 16 * len(self.signal)
+
+    # dither offset, whether a previous epoch is stored
+    PACKED = struct.Struct("<dq")
+
+    def pack(self):
+        sketches = self.current + (self.previous or [])
+        return (self.PACKED.pack(self.offset, self.previous is not None)
+                + "".join(m.pack() for m in self.signal)
+                + "".join(sketch.pack() for sketch in sketches))
+
+    def restore(self, data):
+        (offset, hasPrevious) = self.PACKED.unpack(data[:self.PACKED.size])
+        k = self.PACKED.size
+        signal = []
+        for j in xrange(4):
+            size = EwmaMoments.PACKED.size
+            signal.append(EwmaMoments.unpack(data[k:k + size], self.signalHalflife, warm=True))
+            if signal[j].n and not 0.0 <= signal[j].m <= 1.0:
+                raise ValueError("QuantileDetector snapshot has a mean of counts, not tail positions")
+            k += size
+        sketches = []
+        for j in xrange(8 if hasPrevious else 4):
+            (sketch, size) = P2Histogram.unpack(data[k:], self.cells)
+            if len(sketch.q) > self.cells + 1:
+                raise ValueError("QuantileDetector snapshot has %d cells" % (len(sketch.q) - 1))
+            sketches.append(sketch)
+            k += size
+        self.offset = offset
+        self.signal = signal
+        self.current = sketches[:4]
+        self.previous = sketches[4:] or None
+
+
+# MAD of a normal distribution is 0.6745 stdev
+MAD_SCALE = 1.4826
+
+
+class MedianDetector(WindowDetector):
+
+    """Robust detector on the median and MAD of AnomalyDetector's training window.
+
+    Each direction's training and test rows are kept in motionstats.CountTree
+    objects as SplitWindow moves them in and out, so the medians and the
+    median absolute deviation follow the window at O(log V) per row and a
+    burst, such as a bus passing, moves them by a few samples instead of
+    inflating the spread for the whole window.  The test-window median is
+    scored by its robust z-value ``(test median - median) / (1.4826 * MAD)``,
+    on the same scale as AnomalyDetector.  Comparing medians keeps skewed
+    counts at 0.5 on stationary data, where the mean would sit above the
+    training median; both are interpolated medians, since the plain
+    median of discrete counts is biased the same way.
+
+    :param trainSet: window size, as for AnomalyDetector.  Default: ``20000``
+    :param minMad: MAD floor in counts; more than half the rows can share
+                   one count, which leaves a MAD of 0.  Default: ``0.5``
+    :param zTable: optional motionstats.ZProbTable.  Default: ``None``
+    :param path: keep the window in this motionstats.MappedHistory file.  Default: ``None``
+    """
+
+    def __init__(self, trainSet=20000, minMad=0.5, zTable=None, path=None):
+        self.minMad = float(minMad)
+        WindowDetector.__init__(self, trainSet, zTable, path)
+
+    def resetParts(self):
+        self.trees = [CountTree() for d in DIRECTIONS]
+        self.testTrees = [CountTree() for d in DIRECTIONS]
+
+    def trainRow(self, row, sign):
+        for j in xrange(4):
+            self.trees[j].add(row[j], sign)
+
+    def testRow(self, row, sign):
+        for j in xrange(4):
+            self.testTrees[j].add(row[j], sign)
+
+    def anomalyDetect(self):
+        total = 0.0
+        for j in xrange(4):
+            tree = self.trees[j]
+            median = tree.median()
+            spread = MAD_SCALE * max(tree.mad(median), self.minMad)
+            shift = self.testTrees[j].interpolatedMedian() - tree.interpolatedMedian()
+            total += self.zprob(shift / spread)
+        return total / 4.0
+
+    def nbytes(self):
+        return WindowDetector.nbytes(self) + sum(tree.nbytes()
+                                                 for tree in self.trees + self.testTrees)
+
+
+class ChangeDetector(DetectorEngine):
+
+    """Two-sided CUSUM change-point detector, O(1) per message.
+
+    Each direction's samples are standardized against a slow exponentially
+    weighted baseline, as in EwmaDetector, winsorized at +-`clip` so a
+    single crowded message adds at most `clip` - `drift` however far out
+    it is, and fed to an upper and a lower CUSUM:
+    ``S = max(0, S + z - drift)``, capped at `threshold`.  A change
+    is recorded when a sum reaches the threshold, at the sample number of
+    that message and with the sample its run started from as the estimated
+    onset; the side re-arms once its sum has drained back to zero.
+
+    The score is the mean over the directions of
+    ``0.5 + 0.5 * (upper - lower) / threshold``: 0.5 with no evidence of a
+    change, 1 or 0 while a rise or fall is confirmed.  A shift of `shift`
+    stdevs is confirmed after about ``threshold / (shift - drift)``
+    messages, instead of once it fills a test window.
+
+    :param halflife: baseline half-life in samples.  Default: ``6000``
+    :param drift: allowance per sample in baseline stdevs, about half the
+                  smallest shift worth detecting.  Default: ``0.5``
+    :param threshold: CUSUM decision threshold in stdevs.  Default: ``10.0``
+    :param warmup: samples before the baseline is trusted.  Default: ``100``
+    :param minStdev: baseline stdev floor in counts.  Default: ``0.5``
+    :param clip: largest z-value a sample contributes, in stdevs.  Default: ``2.0``
+    :param events: change events kept for changes().  Default: ``100``
+    """
+
+    def __init__(self, halflife=6000, drift=0.5, threshold=10.0, warmup=100, minStdev=0.5,
+                 clip=2.0, events=100):
+        self.halflife = halflife
+        self.drift = float(drift)
+        self.clip = float(clip)
+        self.threshold = float(threshold)
+        self.warmup = int(warmup)
+        self.minStdev = float(minStdev)
+        self.events = deque(maxlen=int(events))
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.baseline = [EwmaMoments(self.halflife, warm=True) for d in DIRECTIONS]
+        # per direction and side (upper, lower): sum, sample its run started
+        # at, and whether a new change can be recorded
+        self.sums = [[0.0, 0.0] for d in DIRECTIONS]
+        self.starts = [[0, 0] for d in DIRECTIONS]
+        self.armed = [[True, True] for d in DIRECTIONS]
+        self.events.clear()
+
+    def update(self, dat):
+        k = self.count
+        self.count += 1
+        for (j, direction) in enumerate(DIRECTIONS):
+            x = dat[direction]
+            baseline = self.baseline[j]
+            if baseline.n >= self.warmup:
+                z = (x - baseline.m) / max(math.sqrt(baseline.var), self.minStdev)
+                z = min(max(z, -self.clip), self.clip)
+                self.step(j, 0, z, k)
+                self.step(j, 1, -z, k)
+            baseline.update(x)
+
+    def step(self, j, side, z, k):
+        sums = self.sums[j]
+        if sums[side] == 0.0:
+            self.starts[j][side] = k
+        s = min(max(0.0, sums[side] + z - self.drift), self.threshold)
+        sums[side] = s
+        if s >= self.threshold and self.armed[j][side]:
+            self.armed[j][side] = False
+            self.events.append((k, self.starts[j][side], DIRECTIONS[j], side))
+        elif s == 0.0:
+            self.armed[j][side] = True
+
+    def anomalyDetect(self):
+        if self.baseline[0].n < self.warmup:
+            raise ZeroDivisionError("baseline of fewer than %d samples" % self.warmup)
+        total = 0.0
+        for (upper, lower) in self.sums:
+            total += 0.5 + 0.5 * (upper - lower) / self.threshold
+        return total / 4.0
+
+    def changes(self, since=-1):
+        return [{"sample": k, "start": start, "direction": direction,
+                 "change": "fall" if side else "rise"}
+                for (k, start, direction, side) in self.events if k > since]
+
+    def nbytes(self):
+        # baseline moments, then sum, start and armed flag per side, then the
+        # change events kept
+        return (4 * (EwmaMoments.PACKED.size + 2 * self.SIDE.size)
+                + len(self.events) * self.EVENT.size)
+
+    # sample count, then per direction and side: sum, run start, armed
+    PACKED = struct.Struct("<q")
+    SIDE = struct.Struct("<dq?")
+    # a change event: sample, run start, direction and side
+    EVENT = struct.Struct("<qqBB")
+
+    def pack(self):
+        sides = "".join(self.SIDE.pack(self.sums[j][side], self.starts[j][side],
+                                       self.armed[j][side])
+                        for j in xrange(4) for side in (0, 1))
+        return (self.PACKED.pack(self.count) + "".join(m.pack() for m in self.baseline)
+                + sides)
+
+    def restore(self, data):
+        size = EwmaMoments.PACKED.size
+        k = self.PACKED.size + 4 * size
+        if len(data) != k + 8 * self.SIDE.size:
+            raise ValueError("ChangeDetector snapshot has %d bytes" % len(data))
+        self.reset()
+        base = self.PACKED.size
+        self.count = self.PACKED.unpack(data[:base])[0]
+        self.baseline = [EwmaMoments.unpack(data[base + j * size:base + (j + 1) * size],
+                                            self.halflife, warm=True) for j in xrange(4)]
+        for j in xrange(4):
+            for side in (0, 1):
+                (s, start, armed) = self.SIDE.unpack(data[k:k + self.SIDE.size])
+                self.sums[j][side] = s
+                self.starts[j][side] = start
+                self.armed[j][side] = armed
+                k += self.SIDE.size
+
+
+class DivergenceDetector(WindowDetector):
+
+    """Detector on the shape of the motion distribution.
+
+    Each count is quantized into `bins` bins of `width` counts (the last
+    bin takes everything above), and the bin counts of AnomalyDetector's
+    training and test parts are kept as SplitWindow moves rows between
+    them, so a row costs O(1) and a score O(bins) whatever the window
+    length.  A direction's distance is the Jensen-Shannon distance
+    ``sqrt(JS / ln 2)`` of the two histograms, or with ``measure="kl"``
+    ``1 - exp(-KL(test || train))`` with `prior` added to every bin.
+
+    Distances lie in [0, 1] and carry no direction, so the score is
+    ``0.5 + 0.5 * distance`` averaged over the directions: 0.5 when both
+    parts have the same shape, toward 1 as they part.  A change in spread
+    or a second mode counts even when the mean stays put.
+
+    :param trainSet: window size, as for AnomalyDetector.  Default: ``20000``
+    :param bins: bins per direction.  Default: ``16``
+    :param width: counts per bin.  Default: ``4``
+    :param measure: "js" or "kl".  Default: ``'js'``
+    :param prior: pseudo-count per bin for "kl".  Default: ``0.5``
+    :param path: keep the window in this motionstats.MappedHistory file.  Default: ``None``
+    """
+
+    def __init__(self, trainSet=20000, bins=16, width=4, measure="js", prior=0.5, path=None):
+        if measure not in ("js", "kl"):
+            raise ValueError("Unknown divergence measure: %s" % measure)
+        self.bins = int(bins)
+        self.width = int(width)
+        self.measure = measure
+        self.prior = float(prior)
+        WindowDetector.__init__(self, trainSet, None, path)
+
+    def resetParts(self):
+        # bin j * bins + b holds direction j's rows in bin b
+        self.trainBins = array("l", [0]) * (4 * self.bins)
+        self.testBins = array("l", [0]) * (4 * self.bins)
+
+    def count(self, counts, row, sign):
+        last = self.bins - 1
+        for j in xrange(4):
+            counts[j * self.bins + min(row[j] // self.width, last)] += sign
+
+    def trainRow(self, row, sign):
+        self.count(self.trainBins, row, sign)
+
+    def testRow(self, row, sign):
+        self.count(self.testBins, row, sign)
+
+    def distance(self, j):
+        """Distance between the training and test histograms of direction `j`."""
+
+        lo = j * self.bins
+        train = self.trainBins[lo:lo + self.bins]
+        test = self.testBins[lo:lo + self.bins]
+        n = float(sum(train))
+        m = float(sum(test))
+        if not n or not m:
+            raise ZeroDivisionError("histogram of no samples")
+        if self.measure == "kl":
+            prior = self.prior
+            n += prior * self.bins
+            m += prior * self.bins
+            kl = 0.0
+            for b in xrange(self.bins):
+                q = (test[b] + prior) / m
+                kl += q * math.log(q / ((train[b] + prior) / n))
+            return 1.0 - math.exp(-max(kl, 0.0))
+        js = 0.0
+        for b in xrange(self.bins):
+            p = train[b] / n
+            q = test[b] / m
+            mid = 0.5 * (p + q)
+            if p:
+                js += 0.5 * p * math.log(p / mid)
+            if q:
+                js += 0.5 * q * math.log(q / mid)
+        return math.sqrt(max(js, 0.0) / math.log(2))
+
+    def anomalyDetect(self):
+        return sum(0.5 + 0.5 * self.distance(j) for j in xrange(4)) / 4.0
+
+    def nbytes(self):
+        return (WindowDetector.nbytes(self)
+                + self.trainBins.itemsize * (len(self.trainBins) + len(self.testBins)))
+
+
+class TransitionDetector(WindowDetector):
+
+    """Detector on the order of motion states, not their levels.
+
+    Each row is mapped to a motion state: idle when its total count is at
+    most `idle`, else its dominant direction, split in two by whether the
+    total reaches `high`; nine states in all.  Transition counts between
+    consecutive rows are kept for AnomalyDetector's training and test
+    parts as SplitWindow moves rows between them: a row entering a part
+    adds its transition from the row before, a row leaving removes the
+    transition into it.  That leaves the transition into each part's
+    oldest row counted, which scoring takes off again, so the counts are
+    exactly those within each part.  Updates are O(1) and a score is
+    O(states^2).
+
+    The test path is scored by its excess surprise: its mean negative
+    log-likelihood per transition under the training transitions (with
+    `prior` added to every count), less the mean surprise of a training
+    transition under the training counts without it, in units of the
+    stdev of that per-transition surprise, as AnomalyDetector divides by
+    the per-sample stdev.  Leaving each training transition out of its
+    own model makes the reference what an unseen path from the same
+    process scores, where the in-sample entropy rate would be lower.  The
+    score is the zprob of that z-value, 0.5 for a path as likely as the
+    training part's and toward 1 for sequences it rarely or never shows,
+    such as abrupt reversals.
+
+    :param trainSet: window size, as for AnomalyDetector.  Default: ``20000``
+    :param idle: largest total count of an idle row.  Default: ``2``
+    :param high: smallest total count of a busy row.  Default: ``40``
+    :param prior: pseudo-count per transition.  Default: ``0.5``
+    :param zTable: optional motionstats.ZProbTable.  Default: ``None``
+    :param path: keep the window in this motionstats.MappedHistory file.  Default: ``None``
+    """
+
+    STATES = 9
+
+    def __init__(self, trainSet=20000, idle=2, high=40, prior=0.5, zTable=None, path=None):
+        self.idle = idle
+        self.high = high
+        self.prior = float(prior)
+        WindowDetector.__init__(self, trainSet, zTable, path)
+
+    def resetParts(self):
+        # transition a -> b is cell a * STATES + b
+        self.trainCounts = array("l", [0]) * (self.STATES * self.STATES)
+        self.testCounts = array("l", [0]) * (self.STATES * self.STATES)
+        # state of the last row that entered and that left each part
+        self.last = {"train": [None, None], "test": [None, None]}
+
+    def state(self, row):
+        total = row[0] + row[1] + row[2] + row[3]
+        if total <= self.idle:
+            return 0
+        j = max(xrange(4), key=row.__getitem__)
+        return 1 + j + 4 * (total >= self.high)
+
+    def move(self, part, counts, row, sign):
+        s = self.state(row)
+        last = self.last[part]
+        side = 0 if sign > 0 else 1
+        if last[side] is not None:
+            counts[last[side] * self.STATES + s] += sign
+        last[side] = s
+
+    def trainRow(self, row, sign):
+        self.move("train", self.trainCounts, row, sign)
+
+    def testRow(self, row, sign):
+        self.move("test", self.testCounts, row, sign)
+
+    def surprise(self):
+        """Negative log-likelihood per test transition, and the mean and variance of a
+        training transition's leave-one-out surprise."""
+
+        S = self.STATES
+        train = array("l", self.trainCounts)
+        test = array("l", self.testCounts)
+        history = self.window.history
+        for (part, counts, lo, hi) in (("train", train, self.window.trainLo, self.window.trainHi),
+                                       ("test", test, self.window.testLo, self.window.testHi)):
+            out = self.last[part][1]
+            if out is not None and hi > lo:
+                # the transition from the last row that left into the oldest one
+                counts[out * S + self.state(history[lo - history.first])] -= 1
+        total = float(sum(train))
+        steps = float(sum(test))
+        if not total or not steps:
+            raise ZeroDivisionError("no transitions to compare")
+        nll = mean = square = 0.0
+        for a in xrange(S):
+            row = train[a * S:(a + 1) * S]
+            outflow = sum(row) + self.prior * S
+            for b in xrange(S):
+                n = row[b]
+                nll -= test[a * S + b] * math.log((n + self.prior) / outflow)
+                if n:
+                    # a training transition's surprise under the other ones
+                    logp = math.log((n - 1 + self.prior) / (outflow - 1))
+                    p = n / total
+                    mean -= p * logp
+                    square += p * logp * logp
+        return (nll / steps, mean, square - mean * mean)
+
+    def anomalyDetect(self):
+        (nll, mean, variance) = self.surprise()
+        z = (nll - mean) / math.sqrt(max(variance, 1e-12))
+        return self.zprob(z)
+
+    def nbytes(self):
+        return (WindowDetector.nbytes(self)
+                + self.trainCounts.itemsize * (len(self.trainCounts) + len(self.testCounts)))
+
+
+class SpectralBatch(object):
+
+    """Transforms requested by SpectralDetectors, run in batched numpy.fft.rfft calls.
+
+    Detectors submit their recent series as they become due; the batch
+    runs once `limit` streams are waiting or when any member is scored,
+    with every waiting series of one length stacked into a single
+    transform.  Results are delivered under `lock`, which members also
+    hold to read them.
+
+    :param limit: waiting streams that trigger a run.  Default: ``64``
+    """
+
+    def __init__(self, limit=64):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.pending = []       # (detector, (4, size) series)
+        self.runs = 0           # rfft calls
+        self.transforms = 0     # streams transformed
+
+    def submit(self, detector, series):
+        with self.lock:
+            self.pending.append((detector, series))
+            if len(self.pending) >= self.limit:
+                self.run()
+
+    def discard(self, detector):
+        with self.lock:
+            self.pending = [(d, series) for (d, series) in self.pending if d is not detector]
+
+    def flush(self):
+        with self.lock:
+            if self.pending:
+                self.run()
+
+    def run(self):
+        # caller holds self.lock
+        (pending, self.pending) = (self.pending, [])
+        bySize = {}
+        for (detector, series) in pending:
+            bySize.setdefault(series.shape[1], []).append((detector, series))
+        for (size, group) in bySize.items():
+            x = numpy.vstack([series for (detector, series) in group])
+            x -= x.mean(axis=1)[:, numpy.newaxis]
+            x *= numpy.hanning(size)
+            f = numpy.fft.rfft(x, axis=1)
+            power = f.real ** 2 + f.imag ** 2
+            power[:, 0] = 0.0
+            self.runs += 1
+            self.transforms += len(group)
+            for (k, (detector, series)) in enumerate(group):
+                detector.learn(power[4 * k:4 * k + 4])
+
+    def stats(self):
+        return {"runs": self.runs, "transforms": self.transforms, "pending": len(self.pending)}
+
+
+# shared by the SpectralDetectors of a process unless given their own
+SPECTRAL_BATCH = SpectralBatch()
+
+
+class SpectralDetector(DetectorEngine):
+
+    """Detector on the periodicity of each direction's motion.
+
+    Keeps the last `size` samples of each direction and, every `stride`
+    messages, has the window's power spectrum computed by `batch` (a
+    SpectralBatch shared by the process's streams, so many streams take
+    one numpy transform).  It learns an exponentially weighted mean of the
+    normalized spectrum, whose highest non-zero bin is the learned
+    dominant frequency, and the moments of the share of power each
+    transform puts in that bin.  A transform is scored by the z-value of
+    its share against the moments learned before it: near 0.5 while the
+    periodicity holds, toward 0 as it weakens or moves to another
+    frequency, toward 1 as it sharpens.
+
+    Frequencies are in cycles per message, so the stream should arrive
+    at a steady rate; an ingestion policy can make it so.  Needs numpy.
+
+    :param size: samples per transform.  Default: ``512``
+    :param stride: messages between transforms.  Default: ``128``
+    :param halflife: half-life of the learned spectrum, in transforms.  Default: ``100``
+    :param warmup: transforms before scoring.  Default: ``8``
+    :param minStdev: floor of the share's stdev.  Default: ``0.01``
+    :param batch: SpectralBatch to run transforms in.  Default: ``None`` (SPECTRAL_BATCH)
+    :param zTable: optional motionstats.ZProbTable.  Default: ``None``
+    """
+
+    def __init__(self, size=512, stride=128, halflife=100, warmup=8, minStdev=0.01, batch=None,
+                 zTable=None):
+        if numpy is None:
+            raise ImportError("SpectralDetector requires numpy")
+        self.size = int(size)
+        self.stride = int(stride)
+        self.halflife = halflife
+        self.alpha = 1.0 - 0.5 ** (1.0 / halflife)
+        self.warmup = int(warmup)
+        self.minStdev = float(minStdev)
+        self.batch = batch if batch is not None else SPECTRAL_BATCH
+        self.zprob = zprobFor(zTable)
+        self.reset()
+
+    def reset(self):
+        self.batch.discard(self)
+        self.count = 0
+        # direction j's sample k is at j * size + k, written in ring order
+        self.series = array("d", [0.0]) * (4 * self.size)
+        with self.batch.lock:
+            self.transforms = 0
+            self.profile = numpy.zeros((4, self.size // 2 + 1))
+            self.shares = [EwmaMoments(self.halflife, warm=True) for d in DIRECTIONS]
+            self.z = None
+
+    def update(self, dat):
+        size = self.size
+        k = self.count % size
+        series = self.series
+        series[k] = dat["nRight"]
+        series[size + k] = dat["nLeft"]
+        series[2 * size + k] = dat["nUp"]
+        series[3 * size + k] = dat["nDown"]
+        self.count += 1
+        if self.count >= size and not self.count % self.stride:
+            k = self.count % size
+            ring = numpy.frombuffer(series, numpy.float64).reshape(4, size)
+            self.batch.submit(self, numpy.hstack((ring[:, k:], ring[:, :k])))
+
+    def learn(self, power):
+        """Take one transform's (4, bins) power spectrum; called by the batch."""
+
+        total = power.sum(axis=1)[:, numpy.newaxis]
+        shares = power / numpy.where(total > 0, total, 1.0)
+        if self.transforms:
+            peaks = self.profile[:, 1:].argmax(axis=1) + 1
+            x = [shares[j, peaks[j]] for j in xrange(4)]
+            if self.transforms >= self.warmup:
+                self.z = [(x[j] - self.shares[j].m)
+                          / max(math.sqrt(self.shares[j].var), self.minStdev) for j in xrange(4)]
+            for j in xrange(4):
+                self.shares[j].update(x[j])
+        alpha = max(self.alpha, 1.0 / (self.transforms + 1))
+        self.profile += alpha * (shares - self.profile)
+        self.transforms += 1
+
+    def anomalyDetect(self):
+        self.batch.flush()
+        with self.batch.lock:
+            if self.z is None:
+                raise ZeroDivisionError("fewer than %d transforms" % (self.warmup + 1))
+            return sum(self.zprob(z) for z in self.z) / 4.0
+
+    def spectrum(self):
+        """Learned dominant period in messages and its mean share of power, per direction."""
+
+        self.batch.flush()
+        with self.batch.lock:
+            peaks = self.profile[:, 1:].argmax(axis=1) + 1
+            return dict((direction, {"period": self.size / float(peaks[j]),
+                                     "share": self.profile[j, peaks[j]]})
+                        for (j, direction) in enumerate(DIRECTIONS))
+
+    def nbytes(self):
+        return self.series.itemsize * len(self.series) + self.profile.nbytes + 24 * len(self.shares)
+
+    # message count, transforms, whether a z-value is stored
+    PACKED = struct.Struct("<qq?")
+
+    def pack(self):
+        self.batch.flush()
+        with self.batch.lock:
+            z = self.z if self.z is not None else [0.0] * 4
+            return (self.PACKED.pack(self.count, self.transforms, self.z is not None)
+                    + self.series.tostring() + self.profile.tostring()
+                    + "".join(m.pack() for m in self.shares) + struct.pack("<4d", *z))
+
+    def restore(self, data):
+        k = self.PACKED.size
+        series = 8 * len(self.series)
+        profile = 8 * 4 * (self.size // 2 + 1)
+        size = EwmaMoments.PACKED.size
+        if len(data) != k + series + profile + 4 * size + 32:
+            raise ValueError("SpectralDetector snapshot has %d bytes" % len(data))
+        self.reset()
+        (count, transforms, hasZ) = self.PACKED.unpack(data[:k])
+        self.count = count
+        self.series = array("d")
+        self.series.fromstring(data[k:k + series])
+        k += series
+        with self.batch.lock:
+            self.transforms = transforms
+            self.profile = numpy.fromstring(data[k:k + profile]).reshape(4, -1)
+            k += profile
+            self.shares = [EwmaMoments.unpack(data[k + j * size:k + (j + 1) * size],
+                                              self.halflife, warm=True) for j in xrange(4)]
+            k += 4 * size
+            self.z = list(struct.unpack("<4d", data[k:])) if hasZ else None
+
+
+registerEngine("ewma", EwmaDetector)
+registerEngine("time", TimeWindowDetector)
+registerEngine("mahalanobis", MahalanobisDetector)
+registerEngine("quantile", QuantileDetector)
+registerEngine("median", MedianDetector)
+registerEngine("cusum", ChangeDetector)
+registerEngine("divergence", DivergenceDetector)
+registerEngine("markov", TransitionDetector)
+registerEngine("spectral", SpectralDetector)
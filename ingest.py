@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+ingest.py
+
+Per-stream ingestion policies applied before a message reaches its detector.
+
+A policy's ``offer(dat)`` takes every DetectMovement message received for
+a stream and returns the message to hand on, or None, so the rate the
+detector sees is set by the policy instead of the camera's frame rate.
+
+* :class:`KeepEvery` keeps every nth message.
+* :class:`KeepLatest` keeps the last message of each `interval` seconds.
+* :class:`SumInterval` adds up the counts of each `interval` seconds into
+  one message.  Detectors then see motion per interval rather than per
+  frame, so their scores are on that scale.  Sums above the detectors'
+  uint16 history are clamped there; the policy counts them `saturated`.
+
+Interval policies hand on an interval once the first message of a later
+interval arrives.  Message times come from :func:`motionstats.sampleTime`.
+
+Every policy counts messages `received`, `passed` on, `aggregated` into a
+sum and `dropped`; ``received == passed + aggregated + dropped + held``
+where `held` is the messages of the interval still open.
+"""
+
+import math
+import time
+
+from motionstats import DIRECTIONS, TYPECODE_MAX, sampleTime
+
+
+class IngestPolicy(object):
+
+    """Pass every message; the base of the other policies."""
+
+    def __init__(self):
+        self.received = 0
+        self.passed = 0
+        self.aggregated = 0
+        self.dropped = 0
+
+    def offer(self, dat):
+        self.received += 1
+        self.passed += 1
+        return dat
+
+    def stats(self):
+        return {"received": self.received, "passed": self.passed,
+                "aggregated": self.aggregated, "dropped": self.dropped}
+
+
+class KeepEvery(IngestPolicy):
+
+    """Keep the first of every `n` messages.
+
+    :param n: keep one message in n
+    """
+
+    def __init__(self, n):
+        IngestPolicy.__init__(self)
+        self.n = max(int(n), 1)
+
+    def offer(self, dat):
+        self.received += 1
+        if (self.received - 1) % self.n:
+            self.dropped += 1
+            return None
+        self.passed += 1
+        return dat
+
+
+class KeepLatest(IngestPolicy):
+
+    """Keep the last message of each `interval` seconds.
+
+    :param interval: seconds per interval
+    :param timeKey: message field holding the sample time.  Default: ``'timestamp'``
+    :param timeScale: factor converting that field to seconds.  Default: ``1.0``
+    :param clock: arrival-time source.  Default: ``time.time``
+    """
+
+    def __init__(self, interval, timeKey="timestamp", timeScale=1.0, clock=time.time):
+        IngestPolicy.__init__(self)
+        self.interval = float(interval)
+        self.timeKey = timeKey
+        self.timeScale = timeScale
+        self.clock = clock
+        self.bucket = None
+        self.latest = None
+
+    def offer(self, dat):
+        self.received += 1
+        bucket = int(math.floor(sampleTime(dat, self.timeKey, self.timeScale, self.clock)
+                                / self.interval))
+        out = None
+        if self.bucket is None or bucket > self.bucket:
+            out = self.latest
+            self.bucket = bucket
+            if out is not None:
+                self.passed += 1
+        else:
+            # replaced by a later message of the same interval, or late
+            self.dropped += 1
+            if bucket < self.bucket:
+                return None
+        self.latest = dat
+        return out
+
+
+class SumInterval(IngestPolicy):
+
+    """Sum the direction counts of each `interval` seconds into one message.
+
+    The message handed on carries the interval's start time under `timeKey`.
+    Intervals whose sum in any direction exceeds `limit`, which detector
+    histories clamp to, are counted `saturated`; a long interval on a busy
+    stream should be shortened until none are.
+
+    :param interval: seconds per interval
+    :param timeKey: message field holding the sample time.  Default: ``'timestamp'``
+    :param timeScale: factor converting that field to seconds.  Default: ``1.0``
+    :param clock: arrival-time source.  Default: ``time.time``
+    :param limit: largest count a detector history holds.  Default: ``65535``
+    """
+
+    def __init__(self, interval, timeKey="timestamp", timeScale=1.0, clock=time.time,
+                 limit=TYPECODE_MAX["H"]):
+        IngestPolicy.__init__(self)
+        self.interval = float(interval)
+        self.limit = limit
+        self.saturated = 0
+        self.timeKey = timeKey
+        self.timeScale = timeScale
+        self.clock = clock
+        self.bucket = None
+        self.sums = None
+        self.count = 0
+
+    def offer(self, dat):
+        self.received += 1
+        t = sampleTime(dat, self.timeKey, self.timeScale, self.clock)
+        bucket = int(math.floor(t / self.interval))
+        out = None
+        if self.bucket is None or bucket > self.bucket:
+            if self.sums is not None:
+                out = dict(zip(DIRECTIONS, self.sums))
+                out[self.timeKey] = self.bucket * self.interval / self.timeScale
+                self.passed += 1
+                self.aggregated += self.count - 1
+                if max(self.sums) > self.limit:
+                    self.saturated += 1
+            self.bucket = bucket
+            self.sums = [0, 0, 0, 0]
+            self.count = 0
+        elif bucket < self.bucket:
+            # late for an interval already handed on
+            self.dropped += 1
+            return None
+        for (j, direction) in enumerate(DIRECTIONS):
+            self.sums[j] += dat[direction]
+        self.count += 1
+        return out
+
+    def stats(self):
+        stats = IngestPolicy.stats(self)
+        stats["saturated"] = self.saturated
+        return stats
+
+
+POLICIES = {"every": KeepEvery, "latest": KeepLatest, "sum": SumInterval}
+
+
+def makePolicy(name, value):
+    """The policy for option `name` ("every", "latest" or "sum") with argument `value`."""
+
+    if name not in POLICIES:
+        raise ValueError("Unknown ingestion policy: %s" % name)
+    return POLICIES[name](value)
@@ -0,0 +1,1097 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+motionstats.py
+
+Compact storage and statistics helpers for DetectMovement motion vectors.
+
+Each DetectMovement message carries four counts (nRight, nLeft, nUp, nDown).
+The classes here hold those rows for the detectors in :mod:`anomalyApp`
+without allocating a Python list per message, and the normal-distribution
+probability conversion used to score them.
+"""
+
+import os
+import sys
+import math
+import mmap
+import time
+import bisect
+import struct
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# column order of a motion row
+DIRECTIONS = ("nRight", "nLeft", "nUp", "nDown")
+
+# largest count representable per typecode, larger counts are clamped
+TYPECODE_MAX = {"B": 0xff, "H": 0xffff, "I": 0xffffffff}
+
+
+class MotionHistory(object):
+
+    """Fixed-capacity ring buffer of motion rows.
+
+    Rows are stored in one preallocated typed array of capacity*4 small
+    unsigned ints, so appending and evicting never shift memory.  Index 0
+    is the oldest row, negative indices count from the newest.  `first`
+    counts the rows dropped since the last clear(), so row i is sample
+    number first + i.
+
+    :param capacity: number of rows held before the oldest is overwritten
+    :param typecode: array typecode for the counts.  Default: ``'H'`` (uint16)
+    """
+
+    def __init__(self, capacity, typecode="H"):
+        self.capacity = capacity
+        self.typecode = typecode
+        self.limit = TYPECODE_MAX[typecode]
+        self.data = array(typecode, [0]) * (capacity * 4)
+        self.itemsize = self.data.itemsize
+        self.start = 0
+        self.length = 0
+        self.first = 0
+
+    def __len__(self):
+        return self.length
+
+    def _slot(self, i):
+        if i < 0:
+            i += self.length
+        if i < 0 or i >= self.length:
+            raise IndexError("MotionHistory index out of range")
+        return ((self.start + i) % self.capacity) * 4
+
+    def __getitem__(self, i):
+        k = self._slot(i)
+        return self.data[k:k + 4]
+
+    def __iter__(self):
+        for i in xrange(self.length):
+            yield self[i]
+
+    def append(self, row):
+        """Add a row, overwriting the oldest one when full."""
+
+        k = ((self.start + self.length) % self.capacity) * 4
+        try:
+            self.data[k:k + 4] = array(self.typecode, row)
+        except (OverflowError, TypeError):
+            # negative, too large or non-integer counts
+            limit = self.limit
+            self.data[k:k + 4] = array(self.typecode,
+                                       [min(max(int(v), 0), limit) for v in row])
+        if self.length == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+            self.first += 1
+        else:
+            self.length += 1
+
+    def popleft(self):
+        """Drop the oldest row.  Its slot is reused by the next append."""
+
+        if not self.length:
+            raise IndexError("pop from empty MotionHistory")
+        self.start = (self.start + 1) % self.capacity
+        self.length -= 1
+        self.first += 1
+
+    def clear(self):
+        self.start = 0
+        self.length = 0
+        self.first = 0
+
+    def tostring(self):
+        """Rows oldest first as machine-order bytes, for snapshots."""
+
+        (start, length) = (self.start, self.length)
+        end = start + length
+        if end <= self.capacity:
+            return self.data[start * 4:end * 4].tostring()
+        return (self.data[start * 4:].tostring()
+                + self.data[:(end - self.capacity) * 4].tostring())
+
+    def fromstring(self, data):
+        """Replace the rows with tostring() output, keeping the newest that fit."""
+
+        rows = array(self.typecode)
+        rows.fromstring(data)
+        rows = rows[-self.capacity * 4:] if rows else rows
+        self.data[:len(rows)] = rows
+        self.start = 0
+        self.length = len(rows) / 4
+
+    def nbytes(self):
+        """Bytes used by the row storage."""
+
+        return len(self.data) * self.data.itemsize
+
+
+class MappedHistory(object):
+
+    """MotionHistory kept in a memory-mapped file.
+
+    The file is a 64-byte header (magic, version, typecode, capacity and
+    the ring's start, length and first) followed by `capacity` fixed-size
+    little-endian records of four uint16 (typecode ``'H'``) or float32
+    (``'f'``) values.  Rows are read and written in place through the
+    mapping, so the history costs no Python heap, the OS page cache
+    decides what stays resident, and reopening the same path after a
+    restart finds the rows where they were.  A file with a different
+    capacity or typecode is recreated empty.
+
+    :param path: file holding the ring
+    :param capacity: number of rows held before the oldest is overwritten
+    :param typecode: ``'H'`` or ``'f'``.  Default: ``'H'``
+    """
+
+    MAGIC = "MOHR"
+    VERSION = 1
+    # magic, version, typecode, capacity
+    HEADER = struct.Struct("<4sHcxI")
+    # start, length, first
+    RING = struct.Struct("<qqq")
+    RING_OFFSET = 16
+    DATA_OFFSET = 64
+
+    def __init__(self, path, capacity, typecode="H"):
+        self.path = path
+        self.capacity = capacity
+        self.typecode = typecode
+        self.limit = TYPECODE_MAX.get(typecode)
+        self.record = struct.Struct("<4" + typecode)
+        self.itemsize = self.record.size / 4
+        size = self.DATA_OFFSET + capacity * self.record.size
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, typecode, capacity)
+        fresh = True
+        if os.path.exists(path) and os.path.getsize(path) == size:
+            with open(path, "rb") as f:
+                fresh = f.read(self.HEADER.size) != header
+        if fresh:
+            with open(path, "wb") as f:
+                f.truncate(size)
+        self.file = open(path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), size)
+        if fresh:
+            self.map[:self.HEADER.size] = header
+            (self.start, self.length, self.first) = (0, 0, 0)
+            self._sync()
+        else:
+            (self.start, self.length, self.first) = self.RING.unpack_from(self.map, self.RING_OFFSET)
+
+    def _sync(self):
+        self.RING.pack_into(self.map, self.RING_OFFSET, self.start, self.length, self.first)
+
+    def __len__(self):
+        return self.length
+
+    def _offset(self, i):
+        if i < 0:
+            i += self.length
+        if i < 0 or i >= self.length:
+            raise IndexError("MappedHistory index out of range")
+        return self.DATA_OFFSET + ((self.start + i) % self.capacity) * self.record.size
+
+    def __getitem__(self, i):
+        return self.record.unpack_from(self.map, self._offset(i))
+
+    def __iter__(self):
+        for i in xrange(self.length):
+            yield self[i]
+
+    def append(self, row):
+        """Add a row, overwriting the oldest one when full."""
+
+        offset = self.DATA_OFFSET + ((self.start + self.length) % self.capacity) * self.record.size
+        try:
+            self.record.pack_into(self.map, offset, *row)
+        except struct.error:
+            limit = self.limit
+            self.record.pack_into(self.map, offset, *[min(max(v, 0), limit) for v in row])
+        if self.length == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+            self.first += 1
+        else:
+            self.length += 1
+        self._sync()
+
+    def popleft(self):
+        """Drop the oldest row.  Its slot is reused by the next append."""
+
+        if not self.length:
+            raise IndexError("pop from empty MappedHistory")
+        self.start = (self.start + 1) % self.capacity
+        self.length -= 1
+        self.first += 1
+        self._sync()
+
+    def clear(self):
+        (self.start, self.length, self.first) = (0, 0, 0)
+        self._sync()
+
+    def _records(self, lo, hi):
+        # machine-order values of record slots [lo, hi)
+        values = array(self.typecode)
+        values.fromstring(self.map[self.DATA_OFFSET + lo * self.record.size:
+                                   self.DATA_OFFSET + hi * self.record.size])
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    def tostring(self):
+        """Rows oldest first as machine-order bytes, as MotionHistory.tostring()."""
+
+        (start, length) = (self.start, self.length)
+        end = start + length
+        if end <= self.capacity:
+            return self._records(start, end).tostring()
+        return (self._records(start, self.capacity).tostring()
+                + self._records(0, end - self.capacity).tostring())
+
+    def fromstring(self, data):
+        """Replace the rows with tostring() output, keeping the newest that fit."""
+
+        rows = array(self.typecode)
+        rows.fromstring(data)
+        rows = rows[-self.capacity * 4:] if rows else rows
+        if sys.byteorder == "big":
+            rows.byteswap()
+        self.map[self.DATA_OFFSET:self.DATA_OFFSET + len(rows) * self.itemsize] = rows.tostring()
+        (self.start, self.length) = (0, len(rows) / 4)
+        self._sync()
+
+    def nbytes(self):
+        """Bytes of mapped row storage, held in the page cache rather than the heap."""
+
+        return self.capacity * self.record.size
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class SplitWindow(object):
+
+    """MotionHistory split into training and test parts, kept incrementally.
+
+    The window holds up to trainSet-1 rows.  The oldest 90% are training
+    rows, the row at the boundary is skipped and the rest are test rows,
+    the split ``AnomalyDetector.batchDetect()`` uses.  As rows enter and
+    leave a part, ``train(row, sign)`` or ``test(row, sign)`` is called
+    with sign +1 or -1, so detectors can keep per-part statistics current
+    at amortized O(1) per message.
+
+    :param trainSet: window size, as for AnomalyDetector
+    :param train: callback for training rows, or None
+    :param test: callback for test rows, or None
+    """
+
+    def __init__(self, trainSet, train=None, test=None, history=None):
+        # one spare slot keeps an evicted row readable until the next append
+        if history is None:
+            history = MotionHistory(trainSet)
+        self.history = history
+        self.ts = trainSet
+        self.train = train
+        self.test = test
+        if len(history):
+            # a MappedHistory reopened with rows in it
+            self.resume()
+        else:
+            self.reset()
+
+    @property
+    def first(self):
+        return self.history.first
+
+    def reset(self):
+        # absolute sample numbers: history[0] is sample self.first, the
+        # training part is samples [trainLo, trainHi) and the test part
+        # samples [testLo, testHi)
+        self.history.clear()
+        self.trainLo = self.trainHi = 0
+        self.testLo = self.testHi = 0
+
+    def resume(self):
+        """Start the parts over from the rows already in the history."""
+
+        history = self.history
+        while len(history) >= self.ts:
+            # keep the trainSet-1 rows append() would have kept; a MappedHistory
+            # is left full by a process killed between append and popleft
+            history.popleft()
+        self.trainLo = self.trainHi = self.testLo = self.testHi = self.first
+        self.slide(self.first, len(self.history))
+
+    def __len__(self):
+        return len(self.history)
+
+    def append(self, row):
+        history = self.history
+        history.append(row)
+        evict = len(history) == self.ts
+        if self.train is not None or self.test is not None:
+            # move the boundaries while the evicted row is still readable
+            self.slide(history.first + evict, len(history) - evict)
+        if evict:
+            history.popleft()
+
+    def slide(self, first, n):
+        testingIndex = (9*n)/10
+        trainLo, trainHi = first, first + testingIndex
+        testLo, testHi = trainHi + 1, max(trainHi + 1, first + n)
+        history = self.history
+        offset = history.first
+        if self.train is not None:
+            for x in xrange(max(self.trainHi, trainLo), trainHi):
+                self.train(history[x - offset], 1)
+            for x in xrange(self.trainLo, min(self.trainHi, trainLo)):
+                self.train(history[x - offset], -1)
+        if self.test is not None:
+            for x in xrange(max(self.testHi, testLo), testHi):
+                self.test(history[x - offset], 1)
+            for x in xrange(self.testLo, min(self.testHi, testLo)):
+                self.test(history[x - offset], -1)
+        self.trainLo, self.trainHi = trainLo, trainHi
+        self.testLo, self.testHi = testLo, testHi
+
+    PACKED = struct.Struct("<q")
+
+    def pack(self):
+        """Serialize the rows and the sample number of the oldest one."""
+
+        return self.PACKED.pack(self.first) + self.history.tostring()
+
+    def restore(self, data):
+        """Load pack() output, passing every restored row to the callbacks."""
+
+        self.reset()
+        size = self.PACKED.size
+        history = self.history
+        history.fromstring(data[size:])
+        rows = (len(data) - size) / (4 * history.itemsize)
+        history.first = self.PACKED.unpack(data[:size])[0] + rows - len(history)
+        self.resume()
+
+    def trainCount(self):
+        return self.trainHi - self.trainLo
+
+    def testCount(self):
+        return self.testHi - self.testLo
+
+
+Z_MAX = 6.0  # maximum meaningful z-value
+
+
+def zprob(z):
+    """Probability that a standard normal variable is below z.
+
+    Polynomial approximation of the normal CDF used by
+    :meth:`anomalyApp.Normalizer.zprob`.
+    """
+
+    if z == 0.0:
+        x = 0.0
+    else:
+        y = 0.5 * math.fabs(z)
+        if y >= (Z_MAX*0.5):
+            x = 1.0
+        elif (y < 1.0):
+            w = y*y
+            x = ((((((((0.000124818987 * w-0.001075204047) * w +0.005198775019) * w-0.019198292004) * w +0.059054035642) * w-0.151968751364) * w +0.319152932694) * w-0.531923007300) * w +0.797884560593) * y * 2.0
+        else:
+            y = y - 2.0
+            x = (((((((((((((-0.000045255659 * y+0.000152529290) * y -0.000019538132) * y-0.000676904986) * y +0.001390604284) * y-0.000794620820) * y -0.002034254874) * y+0.006549791214) * y -0.010557625006) * y+0.011630447319) * y -0.009279453341) * y+0.005353579108) * y -0.002141268741) * y+0.000535310849) * y +0.999936657524
+    if z > 0.0:
+        prob = ((x+1.0)*0.5)
+    else:
+        prob = ((1.0-x)*0.5)
+    return prob
+
+
+def zprobs(zs):
+    """Vectorized :func:`zprob` over an array of z-values.
+
+    Evaluates the same polynomial in the same order as :func:`zprob`, so
+    results are identical element by element.  Returns a numpy array of
+    the input's shape, or a list when numpy is not installed.
+    """
+
+    if numpy is None:
+        return [zprob(z) for z in zs]
+    z = numpy.asarray(zs, numpy.float64)
+    y = 0.5 * numpy.fabs(z)
+    w = y * y
+    small = ((((((((0.000124818987 * w-0.001075204047) * w +0.005198775019) * w-0.019198292004) * w +0.059054035642) * w-0.151968751364) * w +0.319152932694) * w-0.531923007300) * w +0.797884560593) * y * 2.0
+    y = y - 2.0
+    large = (((((((((((((-0.000045255659 * y+0.000152529290) * y -0.000019538132) * y-0.000676904986) * y +0.001390604284) * y-0.000794620820) * y -0.002034254874) * y+0.006549791214) * y -0.010557625006) * y+0.011630447319) * y -0.009279453341) * y+0.005353579108) * y -0.002141268741) * y+0.000535310849) * y +0.999936657524
+    y = y + 2.0
+    x = numpy.where(y < 1.0, small, large)
+    x = numpy.where(y >= (Z_MAX*0.5), 1.0, x)
+    x = numpy.where(z == 0.0, 0.0, x)
+    return numpy.where(z > 0.0, (x+1.0)*0.5, (1.0-x)*0.5)
+
+
+class ZProbTable(object):
+
+    """Precomputed :func:`zprob` with linear interpolation.
+
+    The table holds zprob at `step` spaced points on [0, Z_MAX] and uses
+    symmetry for negative z.  With the default step of 1/1024 the largest
+    difference from :func:`zprob` is below 3e-8 (see :meth:`max_error`),
+    far under the resolution the anomaly scores are reported at.
+
+    :param step: spacing of the table points, should divide 2.0 so the
+                 polynomial's branch point is a table point.  Default: ``1/1024``
+    """
+
+    def __init__(self, step=1.0 / 1024):
+        self.step = step
+        self.size = int(round(Z_MAX / step))
+        self.table = [zprob(k * step) for k in xrange(self.size + 1)]
+        self.array = numpy.array(self.table) if numpy is not None else None
+
+    def zprob(self, z):
+        """Table lookup equivalent of :func:`zprob` for one z-value."""
+
+        a = math.fabs(z) / self.step
+        if a >= self.size:
+            p = 1.0
+        else:
+            k = int(a)
+            lo = self.table[k]
+            p = lo + (a - k) * (self.table[k + 1] - lo)
+        if z > 0.0:
+            return p
+        return 1.0 - p
+
+    def zprobs(self, zs):
+        """Table lookup equivalent of :func:`zprobs`."""
+
+        if numpy is None:
+            return [self.zprob(z) for z in zs]
+        z = numpy.asarray(zs, numpy.float64)
+        a = numpy.minimum(numpy.fabs(z) / self.step, self.size)
+        k = numpy.minimum(a.astype(numpy.intp), self.size - 1)
+        lo = self.array[k]
+        p = lo + (a - k) * (self.array[k + 1] - lo)
+        return numpy.where(z > 0.0, p, 1.0 - p)
+
+    def max_error(self, points=1000003):
+        """Largest absolute difference from :func:`zprob` on a dense grid over [-Z_MAX-1, Z_MAX+1]."""
+
+        zmax = Z_MAX + 1.0
+        zs = [-zmax + 2.0 * zmax * i / (points - 1) for i in xrange(points)]
+        return max(math.fabs(self.zprob(z) - zprob(z)) for z in zs)
+
+
+class RunningMoments(object):
+
+    """Numerically stable running mean and variance (Welford).
+
+    A drop-in variant of :class:`anomalyApp.Normalizer`: it keeps the count,
+    mean and sum of squared deviations (M2) instead of raw sums, so the
+    stdev does not suffer cancellation on long windows.  Partial moments
+    computed on separate chunks combine exactly with :meth:`merge` (Chan
+    et al.), and :meth:`pack` gives a 16 or 24 byte serialized form.
+    """
+
+    PACKED = {False: struct.Struct("<ddd"), True: struct.Struct("<dff")}
+
+    def __init__(self, n=0, mean=0.0, M2=0.0):
+        self.n = n
+        self.m = mean
+        self.M2 = M2
+
+    @classmethod
+    def fromValues(cls, values):
+        moments = cls()
+        for x in values:
+            moments.update(x)
+        return moments
+
+    def update(self, x):
+        self.n += 1
+        delta = x - self.m
+        self.m += delta / float(self.n)
+        self.M2 += delta * (x - self.m)
+
+    def remove(self, x):
+        """Inverse of update, used when a sample leaves a sliding window."""
+
+        if self.n <= 1:
+            self.n, self.m, self.M2 = 0, 0.0, 0.0
+            return
+        self.n -= 1
+        delta = x - self.m
+        self.m -= delta / float(self.n)
+        self.M2 -= delta * (x - self.m)
+
+    def merge(self, other):
+        """Combine the moments of `other` into this one, in place."""
+
+        n = self.n + other.n
+        if not n:
+            return self
+        delta = other.m - self.m
+        self.M2 += other.M2 + delta * delta * self.n * other.n / float(n)
+        self.m += delta * other.n / float(n)
+        self.n = n
+        return self
+
+    def mean(self):
+        if not self.n:
+            raise ZeroDivisionError("mean of no samples")
+        return self.m
+
+    def variance(self):
+        return max(self.M2, 0.0) / (self.n - 1)
+
+    def stdev(self):
+        return math.sqrt(self.variance())
+
+    def z(self, v):
+        return (v - self.mean()) / self.stdev()
+
+    def zprob(self, z):
+        return zprob(z)
+
+    def valprob(self, v):
+        return zprob(self.z(v))
+
+    def pack(self, single=False):
+        """Serialize to bytes.  single=True stores mean and M2 as float32."""
+
+        return self.PACKED[single].pack(self.n, self.m, self.M2)
+
+    @classmethod
+    def unpack(cls, data):
+        single = len(data) == cls.PACKED[True].size
+        (n, mean, M2) = cls.PACKED[single].unpack(data)
+        return cls(int(n), mean, M2)
+
+
+def columnMoments(rows):
+    """RunningMoments of each direction over an iterable of motion rows.
+
+    Results for separate chunks of a history can be combined with
+    :func:`mergeMoments`, so long recordings can be trained in parallel.
+    """
+
+    moments = [RunningMoments() for d in DIRECTIONS]
+    for row in rows:
+        for j in xrange(4):
+            moments[j].update(row[j])
+    return moments
+
+
+def mergeMoments(parts):
+    """Merge a sequence of columnMoments() results into one."""
+
+    total = [RunningMoments() for d in DIRECTIONS]
+    for part in parts:
+        for j in xrange(4):
+            total[j].merge(part[j])
+    return total
+
+
+class EwmaMoments(object):
+
+    """Exponentially weighted mean and variance of one direction.
+
+    Constant memory and constant work per sample.  The weight of a sample
+    halves every `halflife` samples.  With `warm` the first 1/alpha or so
+    samples are weighted equally, so early moments are the plain sample
+    moments instead of staying pinned near the first sample for several
+    half-lives.
+
+    :param halflife: half-life of a sample's weight, in samples
+    :param warm: weight the first samples equally.  Default: ``False``
+    """
+
+    def __init__(self, halflife, warm=False):
+        self.halflife = halflife
+        self.alpha = 1.0 - 0.5 ** (1.0 / halflife)
+        self.warm = warm
+        self.n = 0
+        self.m = 0.0
+        self.var = 0.0
+
+    def update(self, x):
+        if not self.n:
+            self.m = float(x)
+        else:
+            alpha = self.alpha
+            if self.warm and self.n * alpha < 1.0:
+                alpha = 1.0 / (self.n + 1)
+            diff = x - self.m
+            incr = alpha * diff
+            self.m += incr
+            self.var = (1.0 - alpha) * (self.var + diff * incr)
+        self.n += 1
+
+    def mean(self):
+        if not self.n:
+            raise ZeroDivisionError("mean of no samples")
+        return self.m
+
+    def stdev(self):
+        if self.n < 2:
+            raise ZeroDivisionError("stdev of fewer than 2 samples")
+        return math.sqrt(self.var)
+
+    def z(self, v):
+        return (v - self.mean()) / self.stdev()
+
+    PACKED = struct.Struct("<qdd")
+
+    def pack(self):
+        return self.PACKED.pack(self.n, self.m, self.var)
+
+    @classmethod
+    def unpack(cls, data, halflife, warm=False):
+        moments = cls(halflife, warm)
+        (moments.n, moments.m, moments.var) = cls.PACKED.unpack(data)
+        return moments
+
+
+def sampleTime(dat, timeKey="timestamp", timeScale=1.0, clock=time.time):
+    """Time of a DetectMovement sample in seconds: dat[timeKey] or arrival time."""
+
+    if timeKey in dat:
+        return dat[timeKey] * timeScale
+    return clock()
+
+
+# (seconds per bucket, buckets kept): 15 minutes of 1 s, 6 hours of 10 s,
+# 1 day of 1 min and 1 week of 10 min
+ROLLUP_LEVELS = ((1, 900), (10, 2160), (60, 1440), (600, 1008))
+
+
+class MotionRollup(object):
+
+    """Multi-resolution aggregates of one stream's motion rows.
+
+    Every sample is added to one bucket per level; each level is a bounded
+    ring, so memory is fixed however long the stream runs.  A bucket holds
+    the sample count (uint32) and the sum of each direction (float32), 28
+    bytes with its bucket number, about 150 KB per stream at the default
+    levels.
+
+    :param levels: sequence of (seconds per bucket, bucket count).  Default: ``ROLLUP_LEVELS``
+    """
+
+    def __init__(self, levels=ROLLUP_LEVELS):
+        self.levels = []
+        for (resolution, capacity) in levels:
+            self.levels.append({
+                "resolution": resolution,
+                "capacity": capacity,
+                "bucket": array("l", [-1]) * capacity,
+                "count": array("I", [0]) * capacity,
+                "sums": array("f", [0.0]) * (capacity * 4),
+                })
+
+    def update(self, t, row):
+        """Add motion row `row` sampled at time `t` (seconds)."""
+
+        for level in self.levels:
+            b = int(math.floor(t / level["resolution"]))
+            k = b % level["capacity"]
+            held = level["bucket"][k]
+            if held != b:
+                if held > b:
+                    continue  # older than this level's retention
+                level["bucket"][k] = b
+                level["count"][k] = 0
+                level["sums"][k * 4:k * 4 + 4] = array("f", [0.0]) * 4
+            level["count"][k] += 1
+            sums = level["sums"]
+            for j in xrange(4):
+                sums[k * 4 + j] += row[j]
+
+    def pickLevel(self, start, end, points):
+        """Coarsest level with at least `points` buckets in [start, end).
+
+        Falls back to the finest level when none has that many.  The chosen
+        level can hold many more buckets in the range than `points`; query()
+        merges them.
+        """
+
+        for level in reversed(self.levels):
+            if (end - start) / level["resolution"] >= points:
+                return level
+        return self.levels[0]
+
+    def query(self, start, end, points=100):
+        """Motion history over [start, end) in at most about `points` rows.
+
+        Reads the level chosen by pickLevel and merges runs of adjacent
+        buckets so no more than `points` remain, at least `points` / 2 when
+        the level has that many in the range.  Returns a dict with the row
+        resolution in seconds, the start time of each non-empty row, its
+        sample count and the mean of each direction.  Buckets outside the
+        level's retention are skipped.
+        """
+
+        level = self.pickLevel(start, end, points)
+        r = level["resolution"]
+        capacity = level["capacity"]
+        last = int(math.ceil(end / r))
+        first = max(int(math.floor(start / r)), last - capacity)
+        group = max(1, int(math.ceil((last - first) / float(points))))
+        result = {"resolution": r * group, "times": [], "counts": []}
+        for direction in DIRECTIONS:
+            result[direction] = []
+        for lo in xrange(first, last, group):
+            n = 0
+            sums = [0.0] * 4
+            for b in xrange(lo, min(lo + group, last)):
+                k = b % capacity
+                if level["bucket"][k] != b or not level["count"][k]:
+                    continue
+                n += level["count"][k]
+                for j in xrange(4):
+                    sums[j] += level["sums"][k * 4 + j]
+            if not n:
+                continue
+            result["times"].append(lo * r)
+            result["counts"].append(int(n))
+            for (j, direction) in enumerate(DIRECTIONS):
+                result[direction].append(sums[j] / n)
+        return result
+
+    def nbytes(self):
+        return sum(len(level["bucket"]) * level["bucket"].itemsize
+                   + len(level["count"]) * level["count"].itemsize
+                   + len(level["sums"]) * level["sums"].itemsize
+                   for level in self.levels)
+
+
+class SeasonalProfile(object):
+
+    """Running moments of each direction per time-of-day slot.
+
+    The day (or any `period`) is cut into `slots` equal slots, and each
+    sample updates the count, mean and M2 (as RunningMoments) of the four
+    directions in its slot.  Memory is fixed at slots*9 doubles however
+    long the stream runs.
+
+    :param slots: slots per period.  Default: ``96`` (15 minutes)
+    :param period: seconds per period.  Default: ``86400``
+    """
+
+    def __init__(self, slots=96, period=86400):
+        self.slots = int(slots)
+        self.period = float(period)
+        self.n = array("d", [0.0]) * self.slots
+        self.mean = array("d", [0.0]) * (self.slots * 4)
+        self.M2 = array("d", [0.0]) * (self.slots * 4)
+
+    def slot(self, t):
+        """Slot of time `t` in seconds."""
+
+        return int(math.floor((t % self.period) * self.slots / self.period)) % self.slots
+
+    def update(self, t, row):
+        """Add motion row `row` sampled at time `t` (seconds)."""
+
+        k = self.slot(t)
+        n = self.n[k] + 1
+        self.n[k] = n
+        mean = self.mean
+        M2 = self.M2
+        for j in xrange(4):
+            i = k * 4 + j
+            delta = row[j] - mean[i]
+            mean[i] += delta / n
+            M2[i] += delta * (row[j] - mean[i])
+
+    def count(self, k):
+        return int(self.n[k])
+
+    def moments(self, k):
+        """RunningMoments of each direction in slot `k`."""
+
+        return [RunningMoments(int(self.n[k]), self.mean[k * 4 + j], self.M2[k * 4 + j])
+                for j in xrange(4)]
+
+    def nbytes(self):
+        return self.n.itemsize * (len(self.n) + len(self.mean) + len(self.M2))
+
+    # slots, period
+    HEADER = struct.Struct("<qd")
+
+    def pack(self):
+        return (self.HEADER.pack(self.slots, self.period) + self.n.tostring()
+                + self.mean.tostring() + self.M2.tostring())
+
+    @classmethod
+    def unpack(cls, data):
+        """Rebuild from pack() output; ValueError if the data does not fit."""
+
+        (slots, period) = cls.HEADER.unpack(data[:cls.HEADER.size])
+        profile = cls(slots, period)
+        values = array("d")
+        values.fromstring(data[cls.HEADER.size:])
+        if len(values) != 9 * slots:
+            raise ValueError("SeasonalProfile of %d slots has %d values" % (slots, len(values)))
+        profile.n = values[:slots]
+        profile.mean = values[slots:5 * slots]
+        profile.M2 = values[5 * slots:]
+        return profile
+
+
+class P2Histogram(object):
+
+    """Streaming quantile sketch of one direction (P-square histogram).
+
+    Jain & Chlamtac's P^2 algorithm extended to `cells` equiprobable
+    cells: cells+1 markers track the quantiles 0, 1/cells, ..., 1 with
+    parabolic adjustment, so memory is fixed however many samples are
+    seen.  :meth:`cdf` interpolates between markers; tied markers (common
+    with integer counts) are split at their midpoint.
+
+    :param cells: number of cells.  Default: ``32``
+    """
+
+    def __init__(self, cells=32):
+        self.cells = cells
+        self.n = 0
+        self.q = array("d")     # marker heights, sorted
+        self.pos = array("d")   # marker positions, 1-based ranks
+
+    def update(self, x):
+        b = self.cells
+        self.n += 1
+        if self.n <= b + 1:
+            # exact until every marker has a sample
+            self.q = array("d", sorted(self.q.tolist() + [x]))
+            self.pos = array("d", range(1, self.n + 1))
+            return
+        q = self.q
+        pos = self.pos
+        if x < q[0]:
+            q[0] = float(x)
+            k = 0
+        elif x >= q[b]:
+            q[b] = float(x)
+            k = b - 1
+        else:
+            k = bisect.bisect_right(q, x) - 1
+        for i in xrange(k + 1, b + 1):
+            pos[i] += 1
+        step = (self.n - 1) / float(b)
+        target = 1.0
+        for i in xrange(1, b):
+            target += step
+            d = target - pos[i]
+            if d >= 1:
+                if pos[i + 1] - pos[i] <= 1:
+                    continue
+                s = 1
+            elif d <= -1:
+                if pos[i - 1] - pos[i] >= -1:
+                    continue
+                s = -1
+            else:
+                continue
+            qp = q[i] + s / (pos[i + 1] - pos[i - 1]) * (
+                (pos[i] - pos[i - 1] + s) * (q[i + 1] - q[i]) / (pos[i + 1] - pos[i])
+                + (pos[i + 1] - pos[i] - s) * (q[i] - q[i - 1]) / (pos[i] - pos[i - 1]))
+            if not q[i - 1] < qp < q[i + 1]:
+                qp = q[i] + s * (q[i + s] - q[i]) / (pos[i + s] - pos[i])
+            q[i] = qp
+            pos[i] += s
+
+    def _rank(self, v, below):
+        # piecewise-linear rank through the markers, left (below=True)
+        # or right limit at v
+        q = self.q
+        pos = self.pos
+        last = len(q) - 1
+        if below:
+            j = 0
+            while j <= last and q[j] < v:
+                j += 1
+            if j == 0:
+                return 0.0
+            if j > last:
+                return float(pos[last])
+            i = j - 1
+        else:
+            i = last
+            while i >= 0 and q[i] > v:
+                i -= 1
+            if i < 0:
+                return 0.0
+            if i == last:
+                return float(pos[last])
+        return pos[i] + (v - q[i]) / (q[i + 1] - q[i]) * (pos[i + 1] - pos[i])
+
+    def cdf(self, v):
+        """Estimated fraction of samples below v, ties counted half."""
+
+        if not self.n:
+            raise ZeroDivisionError("cdf of no samples")
+        rank = 0.5 * (self._rank(v, True) + self._rank(v, False))
+        return min(max(rank / self.n, 0.0), 1.0)
+
+    def quantile(self, p):
+        """Estimated p-quantile, 0 <= p <= 1."""
+
+        if not self.n:
+            raise ZeroDivisionError("quantile of no samples")
+        target = 1 + p * (self.n - 1)
+        pos = self.pos
+        for i in xrange(len(pos) - 1):
+            if pos[i + 1] >= target:
+                return self.q[i] + (target - pos[i]) / (pos[i + 1] - pos[i]) * (self.q[i + 1] - self.q[i])
+        return self.q[-1]
+
+    def nbytes(self):
+        return (len(self.q) + len(self.pos)) * self.q.itemsize
+
+    HEADER = struct.Struct("<qq")
+
+    def pack(self):
+        """Serialize to bytes: sample count, marker count, heights and positions."""
+
+        return (self.HEADER.pack(self.n, len(self.q)) + self.q.tostring()
+                + self.pos.tostring())
+
+    @classmethod
+    def unpack(cls, data, cells):
+        """Rebuild from pack() output; returns (histogram, bytes consumed)."""
+
+        sketch = cls(cells)
+        (sketch.n, k) = cls.HEADER.unpack(data[:cls.HEADER.size])
+        start = cls.HEADER.size
+        width = k * sketch.q.itemsize
+        sketch.q.fromstring(data[start:start + width])
+        sketch.pos.fromstring(data[start + width:start + 2 * width])
+        return (sketch, start + 2 * width)
+
+
+class CountTree(object):
+
+    """Multiset of non-negative integer counts with O(log V) rank queries.
+
+    A Fenwick tree over the values 0..size-1, where size is the smallest
+    power of two above the largest value seen, so memory follows the
+    range of the counts (a few hundred bytes for typical DetectMovement
+    counts, at most the typecode's range for clamped history rows), not
+    how many are held.  Adding or removing a value and finding the k-th
+    smallest are O(log V); :meth:`median` and :meth:`mad` are exact.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.tree = array("l", [0]) * 2     # 1-based; tree[i] covers values below i
+
+    def __len__(self):
+        return self.n
+
+    def _grow(self, value):
+        # doubling keeps the old nodes; the only new non-zero node is the
+        # one covering the whole old range
+        while value >= len(self.tree) - 1:
+            size = len(self.tree) - 1
+            self.tree.extend(array("l", [0]) * size)
+            self.tree[2 * size] = self.n
+
+    def add(self, value, count=1):
+        """Add `count` copies of `value`, or remove them if `count` is negative."""
+
+        if value >= len(self.tree) - 1:
+            self._grow(value)
+        self.n += count
+        tree = self.tree
+        i = value + 1
+        size = len(tree)
+        while i < size:
+            tree[i] += count
+            i += i & -i
+
+    def rank(self, value):
+        """Number of values <= `value`."""
+
+        tree = self.tree
+        i = min(int(math.floor(value)) + 1, len(tree) - 1)
+        total = 0
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def select(self, k):
+        """The k-th smallest value, 1 <= k <= len(self)."""
+
+        if not 1 <= k <= self.n:
+            raise IndexError("select(%d) of %d values" % (k, self.n))
+        tree = self.tree
+        size = len(tree) - 1
+        i = 0
+        step = size
+        # binary descent to the largest i whose prefix count is below k;
+        # the k-th value is then at node i + 1, which holds value i
+        while step:
+            if i + step <= size and tree[i + step] < k:
+                k -= tree[i + step]
+                i += step
+            step >>= 1
+        return i
+
+    def median(self):
+        if not self.n:
+            raise ZeroDivisionError("median of no samples")
+        return 0.5 * (self.select((self.n + 1) // 2) + self.select(self.n // 2 + 1))
+
+    def interpolatedMedian(self):
+        """Median with each count spread evenly over [value - 0.5, value + 0.5).
+
+        Moves by fractions as the share of tied values changes, so the
+        medians of two samples of one skewed distribution of counts agree
+        on average, which median() of discrete values does not.
+        """
+
+        if not self.n:
+            raise ZeroDivisionError("median of no samples")
+        m = self.select((self.n + 1) // 2)
+        below = self.rank(m - 1)
+        return m - 0.5 + (0.5 * self.n - below) / (self.rank(m) - below)
+
+    def _within(self, m, d):
+        # values in [m - d, m + d]
+        return self.rank(m + d) - self.rank(math.ceil(m - d) - 1)
+
+    def _deviation(self, m, k):
+        # k-th smallest |x - m|; deviations are multiples of 0.5 since 2m is an integer
+        lo = 0
+        hi = 2 * (len(self.tree) - 1)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._within(m, mid / 2.0) >= k:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo / 2.0
+
+    def mad(self, m=None):
+        """Median absolute deviation from `m`, by default the median."""
+
+        if m is None:
+            m = self.median()
+        return 0.5 * (self._deviation(m, (self.n + 1) // 2)
+                      + self._deviation(m, self.n // 2 + 1))
+
+    def nbytes(self):
+        return len(self.tree) * self.tree.itemsize
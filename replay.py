@@ -0,0 +1,222 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+replay.py
+
+Replay recorded DetectMovement messages through anomalyApp offline.
+
+Recordings are JSONL files with one DetectMovement message per line, as
+written by the app's ``record=<dir>`` init parameter.  A file either holds
+one stream, named after the file (``crowd1.jsonl``), or interleaves several
+streams with a ``stream`` key on every line.  Messages are ordered by their
+``timestamp``; lines without one are spaced `rate` per second per stream
+and given the ``timestamp`` that spacing implies, in `timeScale` units.
+
+:class:`ReplayMo` stands in for :class:`moutil.Mo`, so ``launchVideo`` wires
+up the same ``handleMsg`` -> ``update`` callbacks it would on live
+pipelines, and :class:`Replay` drives them and polls ``anomalyDetect`` the
+way the web client does.
+
+    python replay.py recordings/*.jsonl
+    python replay.py crowds.jsonl --speed 10 --engines "crowd1:ewma"
+    python replay.py recordings/*.jsonl --init fleet=1 --series scores.jsonl
+
+"""
+
+import os
+import sys
+import json
+import time
+import heapq
+import logging
+import argparse
+
+from anomalyApp import anomalyApp
+
+
+class ReplayPipeline(object):
+
+    """A launched pipeline that accepts and ignores control messages."""
+
+    def __init__(self, pipeline_name, **kwargs):
+        self.pipeline_name = pipeline_name
+        self.params = kwargs
+
+    def msg(self, *args, **kwargs):
+        pass
+
+
+class ReplayMo(object):
+
+    """Stand-in for moutil.Mo that keeps the message callbacks of launched pipelines.
+
+    ``callbacks`` maps each pipeline's ``src`` stream to its rx_msg_callback.
+    """
+
+    def __init__(self):
+        self.callbacks = {}
+        self.pipelines = []
+
+    def jlaunch(self, pipeline_name, rx_msg_callback=None, **kwargs):
+        if rx_msg_callback is not None:
+            self.callbacks[kwargs["src"]] = rx_msg_callback
+        pipeline = ReplayPipeline(pipeline_name, **kwargs)
+        self.pipelines.append(pipeline)
+        return pipeline
+
+    def shutdown(self):
+        pass
+
+
+def readRecording(path, rate=10.0, timeScale=1.0):
+    """Yield (seconds, stream, message) from one JSONL recording, in file order."""
+
+    default = os.path.splitext(os.path.basename(path))[0]
+    counts = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            msg = json.loads(line)
+            stream = msg.get("stream", default)
+            k = counts.get(stream, 0)
+            counts[stream] = k + 1
+            if "timestamp" in msg:
+                t = float(msg["timestamp"]) * timeScale
+            else:
+                t = k / rate
+                msg["timestamp"] = t / timeScale
+            yield (t, stream, msg)
+
+
+def readRecordings(paths, rate=10.0, timeScale=1.0):
+    """Merge recordings by time; each file must be in time order."""
+
+    return heapq.merge(*[readRecording(p, rate, timeScale) for p in paths])
+
+
+def percentile(values, p):
+    """Nearest-rank percentile `p` (0-100) of sorted `values`."""
+
+    if not values:
+        return float("nan")
+    k = int(round(p / 100.0 * (len(values) - 1)))
+    return values[k]
+
+
+class Replay(object):
+
+    """Feed recorded messages through an anomalyApp and poll its scores.
+
+    :param specs: addVideo stream specs, "stream" or "stream:engine:opt=val"; streams found only in the recordings get the default engine.  Default: ``()``
+    :param speed: replay at `speed` times real time, 0 for as fast as possible.  Default: ``0``
+    :param poll: recording seconds between anomalyDetect polls.  Default: ``2.0``
+    :param init: anomalyApp init parameters, e.g. {"fleet": "1"}.  Default: ``None``
+    :param log: logger for the app.  Default: ``None`` (the root logger)
+    """
+
+    def __init__(self, specs=(), speed=0, poll=2.0, init=None, log=None):
+        self.specs = dict((spec.split(":", 1)[0], spec) for spec in specs)
+        self.speed = speed
+        self.poll = poll
+        self.app = anomalyApp(log or logging.getLogger(), app_id="replay", app_key="replay")
+        self.app.mo = ReplayMo()
+        self.app.init(**(init or {}))
+        self.streams = []
+        self.messages = 0
+        self.latencies = []
+        self.series = []        # (recording seconds, {stream: anomaly value})
+        self.elapsed = 0.0
+
+    def addStream(self, stream):
+        self.app.GET(commandType="addVideo", argString=self.specs.get(stream, stream))
+        self.streams.append(stream)
+
+    def score(self, t):
+        start = time.time()
+        result = self.app.GET(commandType="anomalyDetect", argString="|".join(self.streams))
+        self.latencies.append(time.time() - start)
+        self.series.append((t, dict((s, result[s]) for s in self.streams if s in result)))
+
+    def run(self, messages):
+        """Replay (seconds, stream, message) tuples in order."""
+
+        callbacks = self.app.mo.callbacks
+        start = time.time()
+        first = nextPoll = None
+        for (t, stream, msg) in messages:
+            if first is None:
+                first = t
+                nextPoll = t + self.poll
+            if stream not in callbacks:
+                self.addStream(stream)
+            if self.speed > 0:
+                delay = (t - first) / self.speed - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            while t >= nextPoll:
+                self.score(nextPoll)    # streams still warming up are left out
+                nextPoll += self.poll
+            callbacks[stream](msg)
+            self.messages += 1
+        self.elapsed = time.time() - start
+        return self.report()
+
+    def report(self):
+        """Throughput, anomalyDetect latency percentiles in ms and poll count."""
+
+        latencies = sorted(self.latencies)
+        report = {"messages": self.messages, "streams": len(self.streams),
+                  "seconds": self.elapsed, "polls": len(latencies),
+                  "msgsPerSec": self.messages / self.elapsed if self.elapsed else 0.0}
+        for p in (50, 90, 99, 100):
+            report["p%d" % p] = percentile(latencies, p) * 1000
+        return report
+
+
+def replay(paths, specs=(), speed=0, poll=2.0, init=None, rate=10.0, timeScale=1.0):
+    """Replay JSONL recordings at `paths`, return the finished Replay."""
+
+    r = Replay(specs, speed=speed, poll=poll, init=init)
+    r.run(readRecordings(paths, rate, timeScale))
+    return r
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="replay recorded DetectMovement messages")
+    parser.add_argument("paths", nargs="+", help="JSONL recordings")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="times real time, 0 for as fast as possible")
+    parser.add_argument("--poll", type=float, default=2.0,
+                        help="recording seconds between anomalyDetect polls")
+    parser.add_argument("--engines", default="",
+                        help="| separated addVideo specs, stream:engine:opt=val")
+    parser.add_argument("--init", default="",
+                        help="comma separated anomalyApp init parameters, key=value")
+    parser.add_argument("--rate", type=float, default=10.0,
+                        help="messages per second per stream for lines without timestamps")
+    parser.add_argument("--time-scale", type=float, default=1.0,
+                        help="seconds per timestamp unit, e.g. 0.001 for milliseconds")
+    parser.add_argument("--series", default="",
+                        help="write the score time series to this JSONL file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    init = dict(kv.split("=", 1) for kv in args.init.split(",") if kv)
+    specs = [spec for spec in args.engines.split("|") if spec]
+    r = replay(args.paths, specs, speed=args.speed, poll=args.poll, init=init,
+               rate=args.rate, timeScale=args.time_scale)
+    report = r.report()
+    sys.stdout.write("%d messages from %d streams in %.2f s: %.0f msgs/sec\n" % (
+                     report["messages"], report["streams"], report["seconds"],
+                     report["msgsPerSec"]))
+    sys.stdout.write("anomalyDetect over %d polls: p50 %.3f ms, p90 %.3f ms, "
+                     "p99 %.3f ms, max %.3f ms\n" % (report["polls"], report["p50"],
+                     report["p90"], report["p99"], report["p100"]))
+    if args.series:
+        with open(args.series, "w") as f:
+            for (t, scores) in r.series:
+                f.write(json.dumps({"time": t, "scores": scores}) + "\n")
+    r.app.shutdown()
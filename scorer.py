@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+scorer.py
+
+Background scoring of every stream on a fixed schedule.
+
+:class:`BackgroundScorer` runs a scoring function on an
+:class:`ApplaunchClass.TimedCallback` thread and publishes the result as a
+:data:`ScoreSnapshot`.  Readers take ``scorer.snapshot`` and get a
+consistent set of scores without computing anything; each cycle builds a
+new snapshot and swaps the reference, and published snapshots are never
+modified.
+
+Cycles are scheduled at a fixed rate, so a slow cycle shortens the wait
+before the next one instead of pushing every later cycle back.  Each
+snapshot records how long its cycle took and how late it started.
+"""
+
+import time
+from collections import namedtuple
+
+from ApplaunchClass import TimedCallback
+
+
+# scores: dict stream -> score, not modified after publishing
+# time: when the cycle started, duration: seconds spent scoring
+# lag: seconds the cycle started after its scheduled time
+# cycle: cycle number, 0 before the first cycle has run
+ScoreSnapshot = namedtuple("ScoreSnapshot", "scores time duration lag cycle")
+
+
+class BackgroundScorer(object):
+
+    """Recompute scores every `interval` seconds on a background thread.
+
+    :param score: callable returning a dict of stream -> score
+    :param interval: seconds between cycle starts.  Default: ``2.0``
+    :param clock: time source.  Default: ``time.time``
+    """
+
+    def __init__(self, score, interval=2.0, clock=time.time):
+        self.score = score
+        self.interval = interval
+        self.clock = clock
+        self.snapshot = ScoreSnapshot({}, 0.0, 0.0, 0.0, 0)
+        self.due = None
+        self.maxDuration = 0.0
+        self.maxLag = 0.0
+        self.overruns = 0       # cycles that took longer than the interval
+        self.errors = 0
+        self.timer = None
+
+    def start(self):
+        self.timer = TimedCallback(callback=self.cycle, interval=self.interval)
+        self.timer.start()
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer.join()
+            self.timer = None
+
+    def cycle(self, **params):
+        """Score once and publish the snapshot; the TimedCallback callback."""
+
+        start = self.clock()
+        lag = max(0.0, start - self.due) if self.due is not None else 0.0
+        try:
+            scores = self.score()
+        except Exception:
+            # keep the last snapshot and the schedule going
+            self.errors += 1
+            scores = None
+        duration = self.clock() - start
+        if scores is not None:
+            self.snapshot = ScoreSnapshot(scores, start, duration, lag,
+                                          self.snapshot.cycle + 1)
+        self.maxDuration = max(self.maxDuration, duration)
+        self.maxLag = max(self.maxLag, lag)
+        if duration > self.interval:
+            self.overruns += 1
+        # next start on the fixed schedule, or now if we are already late
+        self.due = max((self.due or start) + self.interval, self.clock())
+        if self.timer is not None:
+            self.timer.set_interval(max(0.0, self.due - self.clock()))
+
+    def stats(self):
+        """Timing of the last cycle and worst cases since start."""
+
+        snap = self.snapshot
+        return {"interval": self.interval, "cycle": snap.cycle,
+                "duration": snap.duration, "lag": snap.lag,
+                "age": self.clock() - snap.time if snap.cycle else None,
+                "maxDuration": self.maxDuration, "maxLag": self.maxLag,
+                "overruns": self.overruns, "errors": self.errors}
@@ -0,0 +1,265 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+shards.py
+
+Detectors partitioned across worker processes by stream name.
+
+:class:`ShardPool` forks `workers` processes and gives each stream to
+worker ``crc32(name) % workers``, so every message for a stream lands in
+the same process and detectors run outside the app's GIL.  Messages are
+buffered per worker and sent in batches of `batch`; a score request first
+sends what is buffered for its workers, so scores cover every message
+received before the request.  :meth:`ShardPool.anomalyDetect` sends one
+request to each worker involved before waiting for any of them, so the
+workers score their shares in parallel.
+
+:class:`ShardProxy` stands in for a stream's detector and rollup in the
+app, with the :class:`detectors.DetectorEngine` methods and rollup
+queries forwarded to its worker.  Rollups are kept in the workers too, so
+the app process only routes messages.
+"""
+
+import zlib
+import threading
+import multiprocessing
+
+from detectors import DetectorEngine
+from motionstats import sampleTime
+
+
+def serve(conn, build):
+    """Worker loop: apply requests from `conn` to detectors made by `build`."""
+
+    detectors = {}
+    errors = 0
+    while True:
+        request = conn.recv()
+        kind = request[0]
+        if kind == "msgs":
+            for (name, dat) in request[1]:
+                try:
+                    detectors[name].update(dat)
+                except Exception:
+                    # as handleMsg: one bad message must not stop the stream
+                    errors += 1
+        elif kind == "score":
+            scores = {}
+            for name in request[1]:
+                try:
+                    scores[name] = detectors[name].anomalyDetect()
+                except ZeroDivisionError:
+                    scores[name] = None
+            conn.send(scores)
+        elif kind == "add":
+            (name, engine, options) = request[1:]
+            try:
+                detectors[name] = build(name, engine, options)
+                conn.send((True, None))
+            except Exception, e:
+                conn.send((False, e))
+        elif kind == "call":
+            (name, method, args) = request[1:]
+            try:
+                conn.send((True, getattr(detectors[name], method)(*args)))
+            except Exception, e:
+                conn.send((False, e))
+        elif kind == "errors":
+            conn.send(errors)
+        elif kind == "stop":
+            return
+
+
+class ShardStream(object):
+
+    """A worker's stream: its detector and its motionstats.MotionRollup.
+
+    The rollup is None when the app keeps none.  Other attributes are the
+    detector's.
+    """
+
+    def __init__(self, detector, rollup):
+        self.detector = detector
+        self.rollup = rollup
+
+    def __getattr__(self, name):
+        return getattr(self.detector, name)
+
+    def update(self, dat):
+        self.detector.update(dat)
+        if self.rollup is not None:
+            self.rollup.update(sampleTime(dat),
+                               [dat["nRight"], dat["nLeft"], dat["nUp"], dat["nDown"]])
+
+    def query(self, start, end, points=100):
+        return self.rollup.query(start, end, points)
+
+
+class Worker(object):
+
+    """Parent side of one worker process: its pipe, lock and unsent messages."""
+
+    def __init__(self, build):
+        (self.conn, child) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=serve, args=(child, build))
+        self.process.daemon = True
+        self.process.start()
+        child.close()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.sent = 0
+
+    def flush(self):
+        # caller holds self.lock
+        if self.pending:
+            self.conn.send(("msgs", self.pending))
+            self.sent += len(self.pending)
+            self.pending = []
+
+
+class ShardPool(object):
+
+    """Detectors spread over worker processes by crc32 of the stream name.
+
+    :param workers: number of worker processes
+    :param build: build(name, engine, options) returning a stream's detector, called in the worker
+    :param batch: messages buffered per worker before sending.  Default: ``256``
+    """
+
+    def __init__(self, workers, build, batch=256):
+        self.batch = batch
+        self.workers = [Worker(build) for k in xrange(workers)]
+        self.streams = {}       # stream name -> worker index
+
+    def __contains__(self, name):
+        return name in self.streams
+
+    def __len__(self):
+        return len(self.streams)
+
+    def shard(self, name):
+        return (zlib.crc32(name) & 0xffffffff) % len(self.workers)
+
+    def addStream(self, name, engine, options):
+        k = self.shard(name)
+        worker = self.workers[k]
+        with worker.lock:
+            worker.flush()
+            worker.conn.send(("add", name, engine, options))
+            (ok, error) = worker.conn.recv()
+        if not ok:
+            raise error
+        self.streams[name] = k
+        return ShardProxy(self, name)
+
+    def update(self, name, dat):
+        worker = self.workers[self.streams[name]]
+        with worker.lock:
+            worker.pending.append((name, dat))
+            if len(worker.pending) >= self.batch:
+                worker.flush()
+
+    def anomalyDetect(self, names):
+        """Score streams `names` on their workers in parallel.
+
+        Returns a dict of stream name -> score, None for streams still
+        warming up.
+        """
+
+        byWorker = {}
+        for name in names:
+            byWorker.setdefault(self.streams[name], []).append(name)
+        # locks are taken in worker order, so concurrent requests cannot deadlock
+        order = sorted(byWorker)
+        for k in order:
+            worker = self.workers[k]
+            worker.lock.acquire()
+            worker.flush()
+            worker.conn.send(("score", byWorker[k]))
+        scores = {}
+        try:
+            for k in order:
+                scores.update(self.workers[k].conn.recv())
+        finally:
+            for k in order:
+                self.workers[k].lock.release()
+        return scores
+
+    def call(self, name, method, *args):
+        """Run detector method `method` of stream `name` on its worker."""
+
+        worker = self.workers[self.streams[name]]
+        with worker.lock:
+            worker.flush()
+            worker.conn.send(("call", name, method, args))
+            (ok, result) = worker.conn.recv()
+        if not ok:
+            raise result
+        return result
+
+    def stats(self):
+        """Streams, messages sent and handler errors of each worker."""
+
+        stats = []
+        for (k, worker) in enumerate(self.workers):
+            with worker.lock:
+                worker.flush()
+                worker.conn.send(("errors",))
+                errors = worker.conn.recv()
+            stats.append({"streams": self.streams.values().count(k),
+                          "messages": worker.sent, "errors": errors})
+        return stats
+
+    def stop(self):
+        (workers, self.workers) = (self.workers, [])
+        for worker in workers:
+            with worker.lock:
+                worker.flush()
+                worker.conn.send(("stop",))
+        for worker in workers:
+            worker.process.join()
+
+
+class ShardProxy(DetectorEngine):
+
+    """A stream's detector living in a ShardPool worker."""
+
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+
+    def update(self, dat):
+        self.pool.update(self.name, dat)
+
+    def anomalyDetect(self):
+        score = self.pool.anomalyDetect([self.name])[self.name]
+        if score is None:
+            raise ZeroDivisionError("%s is still warming up" % self.name)
+        return score
+
+    def nbytes(self):
+        return self.pool.call(self.name, "nbytes")
+
+    def reset(self):
+        return self.pool.call(self.name, "reset")
+
+    def pack(self):
+        return self.pool.call(self.name, "pack")
+
+    def restore(self, data):
+        return self.pool.call(self.name, "restore", data)
+
+    def stats(self):
+        return self.pool.call(self.name, "stats")
+
+    def changes(self, since=-1):
+        return self.pool.call(self.name, "changes", since)
+
+    def packSidecar(self):
+        return self.pool.call(self.name, "packSidecar")
+
+    def query(self, start, end, points=100):
+        """The stream's MotionRollup.query()."""
+
+        return self.pool.call(self.name, "query", start, end, points)
@@ -0,0 +1,152 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+snapshot.py
+
+Detector state snapshots on local disk, for warm restarts.
+
+Each stream's detector state is written to ``<directory>/<stream>.snap``:
+a fixed header, the engine spec the state belongs to and the engine's
+``pack()`` bytes, zlib-compressed.  Files are written under a temporary
+name and renamed into place, so a crash mid-write leaves the previous
+snapshot intact.
+
+:class:`SnapshotWriter` writes every stream on an
+:class:`ApplaunchClass.TimedCallback` thread.  Packing a detector copies
+its state in memory; compression and disk writes happen outside any lock
+the message handlers take.  Each cycle stops starting new streams once its
+time budget is spent and carries on with the rest next cycle, so the write
+time per cycle is bounded.
+"""
+
+import os
+import zlib
+import time
+import struct
+
+from ApplaunchClass import TimedCallback
+
+
+MAGIC = "MOSN"
+VERSION = 1
+# magic, version, spec length, payload length, payload crc32
+HEADER = struct.Struct("<4sHHII")
+
+
+def snapshotPath(directory, stream):
+    return os.path.join(directory, stream + ".snap")
+
+
+def writeSnapshot(path, spec, state, level=1):
+    """Write engine `state` bytes for `spec` to `path`; returns the file size."""
+
+    payload = zlib.compress(state, level)
+    data = (HEADER.pack(MAGIC, VERSION, len(spec), len(payload),
+                        zlib.crc32(payload) & 0xffffffff) + spec + payload)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.rename(tmp, path)
+    return len(data)
+
+
+def readSnapshot(path):
+    """Return (spec, state bytes) from `path`; ValueError if it is not a valid snapshot."""
+
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        raise ValueError("%s: truncated snapshot" % path)
+    (magic, version, specLength, payloadLength, crc) = HEADER.unpack(data[:HEADER.size])
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("%s: not a version %d snapshot" % (path, VERSION))
+    start = HEADER.size + specLength
+    spec = data[HEADER.size:start]
+    payload = data[start:start + payloadLength]
+    if len(payload) != payloadLength or zlib.crc32(payload) & 0xffffffff != crc:
+        raise ValueError("%s: corrupt snapshot" % path)
+    return (spec, zlib.decompress(payload))
+
+
+class SnapshotWriter(object):
+
+    """Write detector snapshots every `interval` seconds on a background thread.
+
+    :param sources: callable returning a list of (path, spec, pack) where pack() returns the state bytes, or None when there is nothing to write
+    :param directory: where the ``.snap`` files go, created if missing
+    :param interval: seconds between cycle starts.  Default: ``60.0``
+    :param budget: seconds after which a cycle defers its remaining streams.  Default: ``1.0``
+    :param level: zlib compression level.  Default: ``1``
+    :param clock: time source.  Default: ``time.time``
+    """
+
+    def __init__(self, sources, directory, interval=60.0, budget=1.0, level=1,
+                 clock=time.time):
+        self.sources = sources
+        self.directory = directory
+        self.interval = interval
+        self.budget = budget
+        self.level = level
+        self.clock = clock
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.next = 0           # round-robin position of the next stream to write
+        self.cycles = 0
+        self.last = {}
+        self.maxDuration = 0.0
+        self.maxBytes = 0       # largest single snapshot file
+        self.errors = 0
+        self.timer = None
+
+    def start(self):
+        self.timer = TimedCallback(callback=self.cycle, interval=self.interval)
+        self.timer.start()
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer.join()
+            self.timer = None
+
+    def cycle(self, **params):
+        """Write as many streams as the budget allows; the TimedCallback callback."""
+
+        start = self.clock()
+        sources = self.sources()
+        written = size = 0
+        packSeconds = 0.0
+        for k in xrange(len(sources)):
+            if self.clock() - start > self.budget:
+                break
+            (path, spec, pack) = sources[(self.next + k) % len(sources)]
+            written += 1
+            try:
+                t = self.clock()
+                state = pack()
+                packSeconds += self.clock() - t
+                if state is None:
+                    continue
+                n = writeSnapshot(path, spec, state, self.level)
+            except (IOError, OSError):
+                self.errors += 1
+                continue
+            size += n
+            self.maxBytes = max(self.maxBytes, n)
+        if sources:
+            self.next = (self.next + written) % len(sources)
+        duration = self.clock() - start
+        self.cycles += 1
+        self.maxDuration = max(self.maxDuration, duration)
+        self.last = {"duration": duration, "packSeconds": packSeconds,
+                     "streams": written, "deferred": len(sources) - written,
+                     "bytes": size}
+
+    def stats(self):
+        """The last cycle's timing and sizes, and the worst cases since start."""
+
+        stats = {"cycle": self.cycles, "interval": self.interval, "budget": self.budget,
+                 "maxDuration": self.maxDuration, "maxBytes": self.maxBytes,
+                 "errors": self.errors}
+        stats.update(self.last)
+        return stats